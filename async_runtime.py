@@ -0,0 +1,161 @@
+"""per-process event loop, shared HTTP clients and inference executor."""
+
+import asyncio
+import functools
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+# Threads running model inference for async code; two lets a suggestion
+# query be encoded while a sync is encoding a batch of images
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 2))
+# Threads running blocking sync I/O (Shopify pagination, Supabase, sqlite) for
+# async code, so it never queues behind CPU-bound work on the default executor
+BLOCKING_IO_WORKERS = int(os.environ.get("BLOCKING_IO_WORKERS", 16))
+# Connections kept by each shared aiohttp session, in total and per host
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+HTTP_POOL_PER_HOST = int(os.environ.get("HTTP_POOL_PER_HOST", 32))
+
+
+def after_fork(method):
+    """Call a bound method in the child process after every fork.
+
+    Threads, locks held by other threads, sqlite connections and memmaps do
+    not survive a fork (gunicorn preload_app); objects holding them register
+    a reset that drops them, so they are recreated on first use in the child.
+    """
+    ref = weakref.WeakMethod(method)
+
+    def after_in_child():
+        reset = ref()
+        if reset is not None:
+            reset()
+
+    os.register_at_fork(after_in_child=after_in_child)
+
+
+class BackgroundLoop:
+    """An event loop running forever on a daemon thread, one per process.
+
+    Sync code (Flask handlers, job threads) submits coroutines with
+    ``run()``; they share the loop and its connection pools instead of
+    creating a loop per call with ``asyncio.run``.
+    """
+
+    def __init__(self):
+        self._reset()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The process's loop, started on first use"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="event-loop", daemon=True
+                ).start()
+            return self._loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and wait for its result"""
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("run_async() called from the shared event loop")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+background_loop = BackgroundLoop()
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared event loop from sync code"""
+    return background_loop.run(coro, timeout)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(name, factory):
+    """The running loop's instance of a client, created by ``factory`` once.
+
+    Async clients are bound to the loop they were created on, so callers
+    outside the shared loop (e.g. ``asyncio.run`` in scripts) get their own.
+    """
+    loop = asyncio.get_running_loop()
+    with _shared_lock:
+        for key in [key for key in _shared if key[1].is_closed()]:
+            del _shared[key]
+        if (name, loop) not in _shared:
+            _shared[(name, loop)] = factory()
+        return _shared[(name, loop)]
+
+
+def http_session(name):
+    """Pooled keep-alive aiohttp session shared by all requests to a service"""
+    return shared(
+        name,
+        lambda: aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                ttl_dns_cache=300,
+            )
+        ),
+    )
+
+
+class DedicatedExecutor:
+    """Thread pool reserved for one kind of work, one per process"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self._reset()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """The process's thread pool, created on first use"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=self.name
+                )
+            return self._pool
+
+    async def run(self, func, *args):
+        """Run ``func(*args)`` on the pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(func, *args))
+
+
+inference_executor = DedicatedExecutor("inference", INFERENCE_WORKERS)
+blocking_io_executor = DedicatedExecutor("blocking-io", BLOCKING_IO_WORKERS)
+
+
+async def run_inference(func, *args):
+    """Run CPU-bound model inference on the dedicated executor"""
+    return await inference_executor.run(func, *args)
+
+
+async def run_blocking_io(func, *args):
+    """Run blocking sync I/O on its dedicated executor"""
+    return await blocking_io_executor.run(func, *args)
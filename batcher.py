@@ -0,0 +1,142 @@
+"""dynamic micro-batching for model inference."""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from async_runtime import after_fork
+from metrics import CallbackGauge
+
+# How long the first request of a batch waits for others, and the batch limit
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", 5))
+EMBED_MAX_BATCH = int(os.environ.get("EMBED_MAX_BATCH", 32))
+
+
+# Every MicroBatcher, for the scrape-time gauges below
+_batchers = []
+
+
+def batcher_samples(field):
+    """{(batcher name,): stats()[field]} of every batcher"""
+    return {(batcher.name,): batcher.stats()[field] for batcher in _batchers}
+
+
+CallbackGauge(
+    "product_service_batcher_batches",
+    "Inference batches run by each micro-batcher.",
+    ["batcher"],
+    lambda: batcher_samples("batches"),
+)
+CallbackGauge(
+    "product_service_batcher_items",
+    "Items encoded by each micro-batcher.",
+    ["batcher"],
+    lambda: batcher_samples("items"),
+)
+CallbackGauge(
+    "product_service_batcher_occupancy",
+    "Mean batch size of each micro-batcher as a fraction of its maximum.",
+    ["batcher"],
+    lambda: batcher_samples("occupancy"),
+)
+CallbackGauge(
+    "product_service_batcher_queue_depth",
+    "Items waiting in each micro-batcher.",
+    ["batcher"],
+    lambda: {(batcher.name,): batcher._queue.qsize() for batcher in _batchers},
+)
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-item calls into batched calls.
+
+    ``func`` takes a list of items and returns a list of results in the same
+    order. Each caller blocks until its own result is ready; the first item
+    of a batch waits at most ``window_ms`` for up to ``max_batch - 1`` more.
+    When a batch fails its items are retried one at a time, so a bad item
+    only fails its own caller.
+    """
+
+    def __init__(
+        self, name, func, max_batch=EMBED_MAX_BATCH, window_ms=EMBED_BATCH_WINDOW_MS
+    ):
+        self.name = name
+        self.func = func
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self.sizes = {}  # batch size -> number of batches
+        self._reset()
+        after_fork(self._reset)
+        _batchers.append(self)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _ensure_worker(self):
+        # The worker thread is started on first use in each process
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+    def submit(self, item):
+        """Queue an item, return a Future of its result"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _work(self):
+        requests = self._queue
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.sizes[len(batch)] = self.sizes.get(len(batch), 0) + 1
+        try:
+            results = self.func([item for item, _ in batch])
+        except Exception as e:
+            logging.error("%s batch of %d failed: %s", self.name, len(batch), e)
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            for item in batch:
+                self._run([item])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        """Batch count, item count, mean occupancy and batch size histogram"""
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "occupancy": (
+                    self.items / (self.batches * self.max_batch) if self.batches else 0.0
+                ),
+                "sizes": dict(self.sizes),
+            }
@@ -0,0 +1 @@
+"""offline performance benchmarks."""
@@ -0,0 +1,98 @@
+"""Compare IVF approximate search with exact search on a synthetic catalog.
+
+Usage: python -m benchmarks.ann --variants 50000 --nprobe 4 8 16 32
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from embedding_index import IVFIndex, normalize, top_k
+
+
+def synthetic_vectors(size, dim, clusters, rng):
+    """Clustered unit vectors, roughly shaped like CLIP catalog embeddings"""
+    centers = normalize(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(0, clusters, size)
+    noise = rng.standard_normal((size, dim)) * 0.6 / np.sqrt(dim)
+    return normalize(centers[labels] + noise).astype(np.float32)
+
+
+def timed(func, queries):
+    """Run func on every query, return (results, per-query latencies in ms)"""
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(func(query))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def run(variants, dim, queries, k, nprobes, seed=0):
+    """Benchmark exact and IVF search, return a list of result rows"""
+    rng = np.random.default_rng(seed)
+    vectors = synthetic_vectors(variants, dim, max(8, variants // 500), rng)
+    query_vectors = synthetic_vectors(queries, dim, max(8, variants // 500), rng)
+
+    exact, exact_ms = timed(lambda q: top_k(vectors @ q, k), query_vectors)
+    rows = [
+        {
+            "mode": "exact",
+            "variants": variants,
+            "k": k,
+            "recall": 1.0,
+            "p50_ms": float(np.percentile(exact_ms, 50)),
+            "p99_ms": float(np.percentile(exact_ms, 99)),
+        }
+    ]
+
+    start = time.perf_counter()
+    ivf = IVFIndex(vectors)
+    build_s = time.perf_counter() - start
+    for nprobe in nprobes:
+        approx, approx_ms = timed(lambda q: ivf.search(q, k, nprobe)[0], query_vectors)
+        recall = np.mean(
+            [len(set(a) & set(e)) / len(e) for a, e in zip(approx, exact)]
+        )
+        rows.append(
+            {
+                "mode": f"ivf(nprobe={nprobe})",
+                "variants": variants,
+                "k": k,
+                "recall": float(recall),
+                "p50_ms": float(np.percentile(approx_ms, 50)),
+                "p99_ms": float(np.percentile(approx_ms, 99)),
+                "build_s": build_s,
+            }
+        )
+    return rows
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--variants", type=int, nargs="+", default=[5000, 50000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    rows = []
+    for variants in args.variants:
+        rows.extend(run(variants, args.dim, args.queries, args.k, args.nprobe))
+    for row in rows:
+        print(
+            f"{row['variants']:>7} {row['mode']:<16} recall@{row['k']}="
+            f"{row['recall']:.3f} p50={row['p50_ms']:.2f}ms p99={row['p99_ms']:.2f}ms"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
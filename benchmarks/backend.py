@@ -0,0 +1,130 @@
+"""Compare a quantized inference backend with the float32 FashionCLIP model.
+
+Reports cosine agreement of text and image embeddings, and latency and
+throughput at several batch sizes.
+Usage: python -m benchmarks.backend --backend int8 --batch-sizes 1 8 32
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from PIL import Image
+
+from embedding_index import normalize
+from models import FINETUNED_MODEL, get_model
+
+SAMPLE_TEXTS = [
+    "Fall Breezy Dress",
+    "black leather ankle boots",
+    "oversized linen shirt in beige",
+    "high waisted denim shorts",
+    "gold hoop earrings",
+    "red satin slip dress for date night",
+    "chunky knit cardigan",
+    "white canvas sneakers",
+]
+
+
+def sample_images(count, seed=0):
+    """Random RGB images; agreement only needs identical inputs to both models"""
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8))
+        for _ in range(count)
+    ]
+
+
+def agreement(reference, candidate):
+    """Mean and minimum cosine similarity of matching rows"""
+    cosines = np.sum(normalize(reference) * normalize(candidate), axis=1)
+    return float(cosines.mean()), float(cosines.min())
+
+
+def latency(encode, items, batch_size, repeats):
+    """Mean seconds per batch and items per second"""
+    batch = (items * (batch_size // len(items) + 1))[:batch_size]
+    encode(batch, batch_size)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        encode(batch, batch_size)
+    elapsed = (time.perf_counter() - start) / repeats
+    return elapsed, batch_size / elapsed
+
+
+def run(model_name, backend, batch_sizes, repeats):
+    """Benchmark ``backend`` against float32, return a result dict"""
+    reference = get_model(model_name, "torch")
+    candidate = get_model(model_name, backend)
+    images = sample_images(len(SAMPLE_TEXTS))
+
+    text_mean, text_min = agreement(
+        reference.encode_text(SAMPLE_TEXTS, len(SAMPLE_TEXTS)),
+        candidate.encode_text(SAMPLE_TEXTS, len(SAMPLE_TEXTS)),
+    )
+    image_mean, image_min = agreement(
+        reference.encode_images(images, len(images)),
+        candidate.encode_images(images, len(images)),
+    )
+    result = {
+        "model": model_name,
+        "backend": backend,
+        "text_cosine_mean": text_mean,
+        "text_cosine_min": text_min,
+        "image_cosine_mean": image_mean,
+        "image_cosine_min": image_min,
+        "latency": [],
+    }
+    for name, model in (("torch", reference), (backend, candidate)):
+        for batch_size in batch_sizes:
+            text_s, text_rate = latency(
+                model.encode_text, SAMPLE_TEXTS, batch_size, repeats
+            )
+            image_s, image_rate = latency(
+                model.encode_images, images, batch_size, repeats
+            )
+            result["latency"].append(
+                {
+                    "backend": name,
+                    "batch_size": batch_size,
+                    "text_batch_s": text_s,
+                    "text_items_per_s": text_rate,
+                    "image_batch_s": image_s,
+                    "image_items_per_s": image_rate,
+                }
+            )
+    return result
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=FINETUNED_MODEL)
+    parser.add_argument("--backend", default="int8")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    result = run(args.model, args.backend, args.batch_sizes, args.repeats)
+    print(
+        f"cosine agreement: text mean={result['text_cosine_mean']:.4f} "
+        f"min={result['text_cosine_min']:.4f}, image "
+        f"mean={result['image_cosine_mean']:.4f} min={result['image_cosine_min']:.4f}"
+    )
+    for row in result["latency"]:
+        print(
+            f"{row['backend']:<6} batch={row['batch_size']:<3} "
+            f"text {row['text_batch_s'] * 1000:.1f}ms "
+            f"({row['text_items_per_s']:.1f}/s) "
+            f"image {row['image_batch_s'] * 1000:.1f}ms "
+            f"({row['image_items_per_s']:.1f}/s)"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""Local stand-ins for Shopify GraphQL, Supabase REST, the image CDN and OpenAI.
+
+``FakeBackend`` is served over HTTP from a child process by ``serve()``,
+so the real clients (requests, aiohttp, supabase-py) are exercised without
+the stand-ins competing with the service for the GIL. OpenAI and the CLIP
+models are replaced in-process through ``Categorizer.client`` and
+``models.register_model``.
+"""
+
+import asyncio
+import csv
+import json
+import multiprocessing
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from benchmarks.synthetic import PRODUCT_TYPES, image_bytes, shopify_products
+
+PRIMARY_KEYS = {"products": "product_id", "variants": "variant_id", "AppSetup": "shop"}
+# PostgREST query parameters that are not column filters
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def parse_select(select):
+    """Parse a PostgREST select into {column: nested select or None}"""
+    fields, depth, current = [], 0, ""
+    for char in select:
+        depth += (char == "(") - (char == ")")
+        if char == "," and depth == 0:
+            fields.append(current)
+            current = ""
+        else:
+            current += char
+    fields.append(current)
+    spec = {}
+    for field in (field.strip() for field in fields):
+        if not field:
+            continue
+        if "(" in field:
+            name, inner = field.split("(", 1)
+            spec[name.strip()] = parse_select(inner[:-1])
+        else:
+            spec[field] = None
+    return spec
+
+
+def parse_filter(value):
+    """Parse a PostgREST filter such as ``eq.x`` or ``in.("a","b")``"""
+    op, _, arg = value.partition(".")
+    if op == "in":
+        values = csv.reader([arg[1:-1]], escapechar="\\", doublequote=False)
+        return op, set(next(values, []))
+    return op, arg
+
+
+def matches(row, filters):
+    """Whether a row passes every (column, op, arg) filter"""
+    for column, op, arg in filters:
+        value = row.get(column)
+        if op == "eq" and str(value) != arg:
+            return False
+        if op == "in" and str(value) not in arg:
+            return False
+        if op == "is" and (value is None) != (arg == "null"):
+            return False
+        if op == "gt" and (value is None or str(value) <= arg):
+            return False
+    return True
+
+
+class FakeBackend:
+    """In-memory Shopify catalog, Supabase tables and image host.
+
+    ``latency`` maps "shopify", "supabase" and "images" to seconds added
+    to each request, to mimic network round trips. Product queries are
+    charged against a query cost bucket like the Admin API's, restored at
+    ``restore_rate`` points per second.
+    """
+
+    def __init__(self, products=(), latency=None, restore_rate=1000.0):
+        self.products = list(products)
+        self.latency = latency or {}
+        self.bucket_size = 1000.0
+        self.restore_rate = restore_rate
+        self.bucket = self.bucket_size
+        self.bucket_at = time.monotonic()
+        self.tables = {table: {} for table in PRIMARY_KEYS}
+        self.children = {}  # product_id -> variant ids
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.base_url = ""
+        self.bulk_polls = 0
+        self._images = {}
+
+    def reset(self, products=()):
+        """Replace the Shopify catalog and empty every table"""
+        with self.lock:
+            self.products = list(products)
+            self.tables = {table: {} for table in PRIMARY_KEYS}
+            self.children = {}
+            self.requests.clear()
+
+    def upsert(self, table, rows):
+        """Insert or merge rows by primary key, return the stored rows"""
+        key = PRIMARY_KEYS[table]
+        stored = []
+        with self.lock:
+            for row in rows:
+                merged = {**self.tables[table].get(row[key], {}), **row}
+                self.tables[table][row[key]] = merged
+                if table == "variants":
+                    self.children.setdefault(merged["product_id"], {})[
+                        merged["variant_id"]
+                    ] = None
+                stored.append(merged)
+        return stored
+
+    def _candidates(self, table, filters):
+        """Rows possibly matching the filters, using primary keys when filtered"""
+        rows = self.tables[table]
+        for column, op, arg in filters:
+            if column == PRIMARY_KEYS[table] and op in ("eq", "in"):
+                keys = [arg] if op == "eq" else arg
+                return [rows[key] for key in keys if key in rows]
+            if table == "variants" and column == "product_id" and op in ("eq", "in"):
+                keys = [arg] if op == "eq" else arg
+                return [
+                    rows[variant_id]
+                    for key in keys
+                    for variant_id in self.children.get(key, ())
+                ]
+        return list(rows.values())
+
+    def _project(self, row, spec):
+        result = {}
+        for name, nested in spec.items():
+            if name == "*":
+                result.update(row)
+            elif nested is not None:
+                variants = self.tables["variants"]
+                result[name] = [
+                    self._project(variants[variant_id], nested)
+                    for variant_id in self.children.get(row.get("product_id"), ())
+                ]
+            else:
+                result[name] = row.get(name)
+        return result
+
+    def select(self, table, params):
+        """Rows of a PostgREST GET"""
+        filters = [
+            (column, *parse_filter(value))
+            for column, value in params
+            if column not in RESERVED_PARAMS
+        ]
+        options = dict(params)
+        with self.lock:
+            rows = [
+                row for row in self._candidates(table, filters) if matches(row, filters)
+            ]
+            if "order" in options:
+                column, _, direction = options["order"].partition(".")
+                rows.sort(
+                    key=lambda row: str(row.get(column)), reverse=direction == "desc"
+                )
+            offset = int(options.get("offset", 0))
+            if "limit" in options:
+                rows = rows[offset : offset + int(options["limit"])]
+            spec = parse_select(options.get("select", "*"))
+            return [self._project(row, spec) for row in rows]
+
+    def update(self, table, params, values):
+        """Apply a PostgREST PATCH, return the updated rows"""
+        filters = [
+            (column, *parse_filter(value))
+            for column, value in params
+            if column not in RESERVED_PARAMS
+        ]
+        with self.lock:
+            rows = [
+                row for row in self._candidates(table, filters) if matches(row, filters)
+            ]
+            for row in rows:
+                row.update(values)
+            return [dict(row) for row in rows]
+
+    def charge(self, requested, actual):
+        """Take a query's cost from the bucket, return (throttled, cost extension)"""
+        with self.lock:
+            now = time.monotonic()
+            self.bucket = min(
+                self.bucket_size,
+                self.bucket + (now - self.bucket_at) * self.restore_rate,
+            )
+            self.bucket_at = now
+            throttled = requested > self.bucket
+            if not throttled:
+                self.bucket -= actual
+            cost = {
+                "requestedQueryCost": requested,
+                "actualQueryCost": None if throttled else actual,
+                "throttleStatus": {
+                    "maximumAvailable": self.bucket_size,
+                    "currentlyAvailable": int(self.bucket),
+                    "restoreRate": self.restore_rate,
+                },
+            }
+        return throttled, cost
+
+    def graphql(self, query):
+        """Answer the products query of shopify.fetch_products, and bulk queries"""
+        if "bulkOperationRunQuery" in query:
+            self.bulk_polls = 0
+            operation = {"id": "gid://shopify/BulkOperation/1", "status": "CREATED"}
+            return {
+                "data": {
+                    "bulkOperationRunQuery": {
+                        "bulkOperation": operation,
+                        "userErrors": [],
+                    }
+                }
+            }
+        if "currentBulkOperation" in query:
+            # Running on the first poll, so clients exercise polling
+            self.bulk_polls += 1
+            done = self.bulk_polls > 1
+            return {
+                "data": {
+                    "currentBulkOperation": {
+                        "id": "gid://shopify/BulkOperation/1",
+                        "status": "COMPLETED" if done else "RUNNING",
+                        "errorCode": None,
+                        "objectCount": str(
+                            sum(1 + len(p["variants"]["edges"]) for p in self.products)
+                        ),
+                        "url": f"{self.base_url}/bulk/1.jsonl" if done else None,
+                        "partialDataUrl": None,
+                    }
+                }
+            }
+        page = re.search(r'products\(first: (\d+)(?:, after: "([^"]*)")?', query)
+        variants = re.search(r"variants\(first: (\d+)\)", query)
+        first = int(page.group(1))
+        start = int(page.group(2)) + 1 if page.group(2) else 0
+        variant_limit = int(variants.group(1)) if variants else 250
+        # Close to the Admin API's costs: the requested cost assumes full
+        # connections, the actual cost counts the nodes returned
+        requested = 2 + first * (6 + 3 * variant_limit)
+        if requested > self.bucket_size:
+            error = {
+                "message": f"Query cost is {requested}, which exceeds the maximum",
+                "extensions": {"code": "MAX_COST_EXCEEDED", "cost": requested},
+            }
+            return {"errors": [error]}
+        edges = []
+        actual = 2
+        for index in range(start, min(start + first, len(self.products))):
+            node = dict(self.products[index])
+            product_variants = node["variants"]["edges"]
+            node["variants"] = {
+                "pageInfo": {"hasNextPage": len(product_variants) > variant_limit},
+                "edges": product_variants[:variant_limit],
+            }
+            actual += 6 + 3 * len(node["variants"]["edges"])
+            edges.append({"cursor": str(index), "node": node})
+        throttled, cost = self.charge(requested, actual)
+        if throttled:
+            error = {"message": "Throttled", "extensions": {"code": "THROTTLED"}}
+            return {"errors": [error], "extensions": {"cost": cost}}
+        return {
+            "data": {
+                "products": {
+                    "edges": edges,
+                    "pageInfo": {"hasNextPage": start + first < len(self.products)},
+                }
+            },
+            "extensions": {"cost": cost},
+        }
+
+    def bulk_jsonl(self):
+        """Bulk operation result: each product line followed by its variants"""
+        for product in self.products:
+            node = {key: value for key, value in product.items() if key != "variants"}
+            yield json.dumps(node).encode("utf-8") + b"\n"
+            for edge in product["variants"]["edges"]:
+                variant = {**edge["node"], "__parentId": product["id"]}
+                yield json.dumps(variant).encode("utf-8") + b"\n"
+
+    def image(self, name):
+        """PNG bytes of an image path, generated once"""
+        if name not in self._images:
+            self._images[name] = image_bytes(name)
+        return self._images[name]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Routes requests to the FakeBackend of the server"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; avoid delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status, body=b"", content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def _route(self, method):
+        backend = self.server.backend
+        parts = urlsplit(self.path)
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        if parts.path.startswith("/_bench/"):
+            return self._control(parts.path[len("/_bench/") :])
+        if parts.path.startswith("/rest/v1/"):
+            service, table = "supabase", parts.path[len("/rest/v1/") :]
+        elif parts.path.endswith("/graphql.json") or parts.path.startswith("/bulk/"):
+            service, table = "shopify", None
+        elif parts.path.startswith("/images/"):
+            service, table = "images", None
+        else:
+            return self._reply(404, {"error": "not found"})
+        backend.requests[f"{service} {method}"] += 1
+        time.sleep(backend.latency.get(service, 0))
+
+        if service == "images":
+            return self._reply(200, backend.image(parts.path), "image/png")
+        if parts.path.startswith("/bulk/"):
+            return self._reply(200, b"".join(backend.bulk_jsonl()), "application/jsonl")
+        if service == "shopify":
+            return self._reply(200, backend.graphql(self._body()["query"]))
+        if table not in PRIMARY_KEYS:
+            return self._reply(404, {"message": f"unknown table {table}"})
+        if method == "GET":
+            return self._reply(200, backend.select(table, params))
+        if method == "POST":
+            body = self._body()
+            rows = backend.upsert(table, body if isinstance(body, list) else [body])
+            if "return=representation" in self.headers.get("Prefer", ""):
+                return self._reply(201, rows)
+            return self._reply(201, [])
+        return self._reply(200, backend.update(table, params, self._body()))
+
+    def _control(self, command):
+        """Benchmark control: reset the catalog, read and clear request counts"""
+        backend = self.server.backend
+        if command == "reset":
+            body = self._body()
+            host, port = self.server.server_address[:2]
+            backend.reset(
+                shopify_products(
+                    body["products"],
+                    body["variants"],
+                    f"http://{host}:{port}",
+                    body.get("seed", 0),
+                )
+            )
+            return self._reply(200, {})
+        if command == "requests":
+            with backend.lock:
+                counts = dict(backend.requests)
+                backend.requests.clear()
+            return self._reply(200, counts)
+        return self._reply(404, {"error": f"unknown command {command}"})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """GET"""
+        self._route("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """POST"""
+        self._route("POST")
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        """PATCH"""
+        self._route("PATCH")
+
+
+def _serve_forever(latency, restore_rate, host, ready):
+    server = ThreadingHTTPServer((host, 0), Handler)
+    server.daemon_threads = True
+    server.backend = FakeBackend(latency=latency, restore_rate=restore_rate)
+    server.backend.base_url = f"http://{host}:{server.server_address[1]}"
+    ready.put(server.backend.base_url)
+    server.serve_forever()
+
+
+def serve(latency=None, restore_rate=1000.0, host="127.0.0.1"):
+    """Serve a FakeBackend from a daemon process, return (process, base url)"""
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve_forever, args=(latency, restore_rate, host, ready), daemon=True
+    )
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+class FakeOpenAI:
+    """AsyncOpenAI stand-in answering category and tag prompts"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        prompt = messages[-1]["content"].lower()
+        category = next((t for t in PRODUCT_TYPES if t in prompt), "accessory")
+        answer = {
+            "productCategory": category.title(),
+            "occasionTags": ["casual"],
+            "seasonalTags": ["summer"],
+            "styleTags": ["classic"],
+            "descriptionAnalysis": ["soft"],
+            "colourAndTone": ["Neutral"],
+        }
+        message = SimpleNamespace(content=json.dumps(answer))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class StubModel:
+    """Deterministic FashionCLIP stand-in.
+
+    Embeddings are seeded by the input, so equal inputs get equal vectors;
+    ``seconds_per_item`` adds a fixed inference cost per text or image.
+    """
+
+    def __init__(self, dim=512, seconds_per_item=0.0):
+        self.dim = dim
+        self.seconds_per_item = seconds_per_item
+
+    def _vectors(self, keys):
+        time.sleep(self.seconds_per_item * len(keys))
+        vectors = [
+            np.random.default_rng(zlib.crc32(key)).standard_normal(self.dim)
+            for key in keys
+        ]
+        return np.asarray(vectors, dtype=np.float32).reshape(len(keys), self.dim)
+
+    def encode_text(self, texts, batch_size=32):
+        """FashionCLIP.encode_text"""
+        return self._vectors([text.encode("utf-8") for text in texts])
+
+    def encode_images(self, images, batch_size=32):
+        """FashionCLIP.encode_images"""
+        return self._vectors([image.tobytes()[:4096] for image in images])
@@ -0,0 +1,77 @@
+"""Compare compact embedding formats with float32 JSON on a synthetic catalog.
+
+Reports bytes per vector, decode time and recall@k of the top-k ranking.
+Usage: python -m benchmarks.quantization --variants 20000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.ann import synthetic_vectors
+from embedding_codec import encode
+from embedding_index import as_vector, normalize, top_k
+
+
+def run(variants, dim, queries, k, seed=0):
+    """Benchmark each storage format, return a list of result rows"""
+    rng = np.random.default_rng(seed)
+    vectors = synthetic_vectors(variants, dim, max(8, variants // 500), rng)
+    query_vectors = synthetic_vectors(queries, dim, max(8, variants // 500), rng)
+    exact = [top_k(vectors @ q, k) for q in query_vectors]
+
+    rows = []
+    for fmt in ("float32", "float16", "int8"):
+        if fmt == "float32":
+            stored = [json.dumps(v.tolist()) for v in vectors]
+        else:
+            stored = [encode(v, fmt) for v in vectors]
+
+        start = time.perf_counter()
+        decoded = normalize(np.vstack([as_vector(item) for item in stored]))
+        decode_s = time.perf_counter() - start
+
+        recall = np.mean(
+            [
+                len(set(top_k(decoded @ q, k)) & set(e)) / k
+                for q, e in zip(query_vectors, exact)
+            ]
+        )
+        rows.append(
+            {
+                "format": fmt,
+                "variants": variants,
+                "k": k,
+                "bytes_per_vector": float(np.mean([len(item) for item in stored])),
+                "decode_s": decode_s,
+                "recall": float(recall),
+            }
+        )
+    return rows
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--variants", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    rows = run(args.variants, args.dim, args.queries, args.k)
+    for row in rows:
+        print(
+            f"{row['format']:<8} {row['bytes_per_vector']:>8.0f} B/vector "
+            f"decode={row['decode_s']:.3f}s recall@{row['k']}={row['recall']:.3f}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
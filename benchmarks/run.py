@@ -0,0 +1,331 @@
+"""End-to-end offline benchmarks of the sync, suggestion and embed paths.
+
+Starts local stand-ins for Shopify, Supabase, the image CDN and OpenAI,
+points the service at them and writes throughput and latency as JSON.
+Usage: python -m benchmarks.run --products 500 --catalog-sizes 200 1000 5000 \
+    --output bench.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmarks.fakes import FakeOpenAI, StubModel, serve
+from benchmarks.synthetic import PRODUCT_TYPES, catalog_rows, shopify_products
+
+TOKEN = "bench-token"
+QUERIES = [
+    f"{style} {colour} outfit for {occasion}"
+    for style in ("breezy", "classic", "oversized", "vintage")
+    for colour in ("black", "beige", "red", "navy", "olive")
+    for occasion in ("the office", "a date night", "the beach")
+]
+
+
+def configure(base_url, workdir):
+    """Point the service at the stand-ins; must run before importing it"""
+    os.environ.update(
+        {
+            "SUPABASE_URL": base_url,
+            # supabase-py only checks the key looks like a JWT
+            "SUPABASE_ANON_KEY": "bench.anon.key",
+            "TOKEN": TOKEN,
+            "API_VERSION": "bench",
+            "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.sqlite3"),
+            "SYNC_JOBS_PATH": os.path.join(workdir, "sync_jobs.sqlite3"),
+            "WEBHOOK_QUEUE_PATH": os.path.join(workdir, "webhook_queue.sqlite3"),
+            "IMAGE_CACHE_DIR": os.path.join(workdir, "image_cache"),
+            "PRELOAD_MODELS": "",
+        }
+    )
+
+
+def control(base_url, command, body=None):
+    """Send a control command to the stand-in process"""
+    if body is None:
+        response = requests.get(f"{base_url}/_bench/{command}", timeout=60)
+    else:
+        response = requests.post(f"{base_url}/_bench/{command}", json=body, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def seed(base_url, table, rows, chunk=500):
+    """Insert rows into a stand-in Supabase table"""
+    for i in range(0, len(rows), chunk):
+        response = requests.post(
+            f"{base_url}/rest/v1/{table}", json=rows[i : i + chunk], timeout=60
+        )
+        response.raise_for_status()
+
+
+def summarize(latencies_ms):
+    """p50, p99 and mean of a list of latencies in ms"""
+    latencies = np.asarray(latencies_ms)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+def bench_sync(base_url, products, variants, llm, ingest="pages"):
+    """Full sync of a synthetic store, then an unchanged re-sync"""
+    from async_runtime import run_async
+    from process_product import handle_product_sync
+    from shopify import iter_products, iter_products_bulk
+
+    shop = "bench-sync.myshopify.com"
+    control(base_url, "reset", {"products": products, "variants": variants})
+    seed(base_url, "AppSetup", [{"shop": shop, "productSyncStatus": None}])
+    url = f"{base_url}/admin/api/bench/graphql.json"
+
+    fetch = iter_products_bulk if ingest == "bulk" else iter_products
+    result = {"products": products, "variants_per_product": variants, "ingest": ingest}
+    for run in ("cold", "unchanged"):
+        llm.calls = 0
+        control(base_url, "requests")
+        start = time.perf_counter()
+        counts = run_async(handle_product_sync(fetch(url, {}), shop))
+        elapsed = time.perf_counter() - start
+        result[run] = {
+            "seconds": elapsed,
+            "products_per_s": products / elapsed,
+            "variants_per_s": products * variants / elapsed,
+            "processed": counts["processed"],
+            "skipped": counts["skipped"],
+            "llm_calls": llm.calls,
+            "requests": control(base_url, "requests"),
+        }
+    return result
+
+
+def bench_suggestions(base_url, sizes, variants, count, k):
+    """Cold and warm /fetch-suggestions latency for each catalog size"""
+    from main import app
+
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    rng = np.random.default_rng(0)
+    results = []
+    for size in sizes:
+        shop = f"bench-{size}.myshopify.com"
+        control(base_url, "reset", {"products": 0, "variants": 0})
+        product_rows, variant_rows = catalog_rows(
+            shop, shopify_products(size, variants, base_url)
+        )
+        seed(base_url, "products", product_rows)
+        seed(base_url, "variants", variant_rows)
+
+        def payload():
+            types = rng.choice(PRODUCT_TYPES, 3, replace=False)
+            return {
+                "shop_url": shop,
+                "inputs": [
+                    {"item_type": item_type, "input": rng.choice(QUERIES)}
+                    for item_type in types
+                ],
+                "k": k,
+            }
+
+        start = time.perf_counter()
+        response = client.post("/fetch-suggestions", json=payload(), headers=headers)
+        cold_ms = (time.perf_counter() - start) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f"/fetch-suggestions failed: {response.get_data()}")
+
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            response = client.post(
+                "/fetch-suggestions", json=payload(), headers=headers
+            )
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append(
+            {
+                "products": size,
+                "variants": size * variants,
+                "requests": count,
+                "cold_ms": cold_ms,
+                "response_bytes": len(response.get_data()),
+                **summarize(latencies),
+            }
+        )
+    return results
+
+
+def bench_endpoint(path, bodies, concurrency):
+    """POST every body to an endpoint from ``concurrency`` threads"""
+    from main import app
+
+    def post(body):
+        start = time.perf_counter()
+        response = app.test_client().post(path, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} failed: {response.get_data()}")
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(post, bodies))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(bodies),
+        "concurrency": concurrency,
+        "requests_per_s": len(bodies) / elapsed,
+        **summarize(latencies),
+    }
+
+
+def bench_embed(base_url, count, concurrency, batch_size):
+    """Throughput of the single and batch /embed-* endpoints"""
+    from fashion import image_batcher, text_batcher
+
+    images = [f"{base_url}/images/embed-{i}.png" for i in range(count)]
+    batch_images = [f"{base_url}/images/batch-{i}.png" for i in range(count)]
+    texts = [f"{QUERIES[i % len(QUERIES)]} #{i}" for i in range(count)]
+    batches = range(0, count, batch_size)
+    result = {
+        "embed_text": bench_endpoint(
+            "/embed-text", [{"description": text} for text in texts], concurrency
+        ),
+        "embed_image": bench_endpoint(
+            "/embed-image", [{"imageUrl": url} for url in images], concurrency
+        ),
+        "embed_text_batch": bench_endpoint(
+            "/embed-text/batch",
+            [{"descriptions": texts[i : i + batch_size]} for i in batches],
+            concurrency,
+        ),
+        # Fresh images, so the image cache does not serve the batch run
+        "embed_image_batch": bench_endpoint(
+            "/embed-image/batch",
+            [{"imageUrls": batch_images[i : i + batch_size]} for i in batches],
+            concurrency,
+        ),
+        "batchers": {"text": text_batcher.stats(), "image": image_batcher.stats()},
+    }
+    result["embed_text_batch"]["items_per_s"] = (
+        result["embed_text_batch"]["requests_per_s"] * count / len(batches)
+    )
+    result["embed_image_batch"]["items_per_s"] = (
+        result["embed_image_batch"]["requests_per_s"] * count / len(batches)
+    )
+    return result
+
+
+def run(args, workdir):
+    """Run every selected benchmark, return the results dict"""
+    latency = {
+        "shopify": args.shopify_latency_ms / 1000,
+        "supabase": args.supabase_latency_ms / 1000,
+        "images": args.image_latency_ms / 1000,
+    }
+    server, base_url = serve(latency, args.shopify_restore_rate)
+    configure(base_url, workdir)
+
+    import categorize
+    import models
+
+    llm = FakeOpenAI(latency=args.llm_latency_ms / 1000)
+    categorize.categorizer.client = llm
+    if args.model == "stub":
+        stub = StubModel(seconds_per_item=args.encode_ms / 1000)
+        for name in {models.BASE_MODEL, models.FINETUNED_MODEL}:
+            models.register_model(name, stub)
+
+    results = {"config": vars(args)}
+    try:
+        if "sync" in args.benchmarks:
+            results["sync"] = bench_sync(
+                base_url, args.products, args.variants, llm, args.ingest
+            )
+        if "suggestions" in args.benchmarks:
+            results["suggestions"] = bench_suggestions(
+                base_url, args.catalog_sizes, args.variants, args.requests, args.k
+            )
+        if "embed" in args.benchmarks:
+            results["embed"] = bench_embed(
+                base_url, args.embed_requests, args.concurrency, args.batch_size
+            )
+    finally:
+        server.terminate()
+    return results
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=["sync", "suggestions", "embed"],
+        default=["sync", "suggestions", "embed"],
+    )
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--variants", type=int, default=4)
+    parser.add_argument("--ingest", choices=["pages", "bulk"], default="pages")
+    parser.add_argument(
+        "--catalog-sizes", type=int, nargs="+", default=[200, 1000, 5000]
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--embed-requests", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument(
+        "--model",
+        choices=["stub", "real"],
+        default="stub",
+        help="stub: deterministic stand-in; real: load FashionCLIP",
+    )
+    parser.add_argument("--encode-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--shopify-latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--shopify-restore-rate",
+        type=float,
+        default=1000.0,
+        help="query cost points restored per second, e.g. 100 for a standard plan",
+    )
+    parser.add_argument("--supabase-latency-ms", type=float, default=0.0)
+    parser.add_argument("--image-latency-ms", type=float, default=0.0)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        results = run(args, workdir)
+
+    if "sync" in results:
+        sync = results["sync"]
+        for name in ("cold", "unchanged"):
+            print(
+                f"sync {name:<9} {sync[name]['seconds']:.2f}s "
+                f"({sync[name]['products_per_s']:.1f} products/s, "
+                f"{sync[name]['llm_calls']} LLM calls)"
+            )
+    for row in results.get("suggestions", []):
+        print(
+            f"suggestions products={row['products']:<6} cold={row['cold_ms']:.1f}ms "
+            f"p50={row['p50_ms']:.2f}ms p99={row['p99_ms']:.2f}ms "
+            f"response={row['response_bytes']}B"
+        )
+    for name, row in results.get("embed", {}).items():
+        if name != "batchers":
+            print(
+                f"{name:<18} {row['requests_per_s']:.1f} req/s "
+                f"p50={row['p50_ms']:.2f}ms p99={row['p99_ms']:.2f}ms"
+            )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Synthetic Shopify catalogs, stored rows and images for the benchmarks."""
+
+import io
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from embedding_index import normalize
+
+PRODUCT_TYPES = ["dress", "top", "shorts", "pants", "accessory"]
+COLOURS = ["black", "white", "beige", "red", "navy", "olive", "pink", "gold"]
+STYLES = ["breezy", "classic", "oversized", "fitted", "vintage", "cropped"]
+SIZES = ["XS", "S", "M", "L", "XL", "XXL"]
+
+
+def shopify_products(count, variants, image_base, seed=0):
+    """Product nodes shaped like the Admin GraphQL response of fetch_products.
+
+    Every product has ``variants`` variants with an image of their own;
+    titles contain the product type so the OpenAI stand-in can answer.
+    """
+    rng = np.random.default_rng(seed)
+    products = []
+    for i in range(count):
+        product_type = PRODUCT_TYPES[i % len(PRODUCT_TYPES)]
+        colour = COLOURS[rng.integers(len(COLOURS))]
+        style = STYLES[rng.integers(len(STYLES))]
+        price = f"{rng.integers(15, 250)}.00"
+        products.append(
+            {
+                "id": f"gid://shopify/Product/{i + 1}",
+                "title": f"{style.title()} {colour} {product_type} {i + 1}",
+                "description": (
+                    f"A {style} {colour} {product_type} in soft cotton, "
+                    f"style number {i + 1}."
+                ),
+                "tags": [style, colour],
+                "totalInventory": variants * 10,
+                "onlineStoreUrl": f"https://bench.example/products/{i + 1}",
+                "priceRange": {"maxVariantPrice": {"amount": price}},
+                "featuredImage": {"url": f"{image_base}/images/{i + 1}.png"},
+                "productType": product_type,
+                "vendor": "bench",
+                "updatedAt": "2026-01-01T00:00:00Z",
+                "variants": {
+                    "edges": [
+                        {
+                            "node": {
+                                "id": f"gid://shopify/ProductVariant/{i * variants + j + 1}",
+                                "price": price,
+                                "title": SIZES[j % len(SIZES)],
+                                "inventoryQuantity": 10,
+                                "image": {
+                                    "url": f"{image_base}/images/{i + 1}-{j + 1}.png"
+                                },
+                                "selectedOptions": [
+                                    {"name": "Size", "value": SIZES[j % len(SIZES)]}
+                                ],
+                            }
+                        }
+                        for j in range(variants)
+                    ]
+                },
+            }
+        )
+    return products
+
+
+def random_embeddings(count, dim, rng):
+    """Random unit vectors as float lists"""
+    return normalize(rng.standard_normal((count, dim))).round(6).tolist()
+
+
+def catalog_rows(shop, products, dim=512, seed=0):
+    """Stored 'products' and 'variants' rows of a synced catalog.
+
+    Rows are built like BulkWriter builds them, with random embeddings, so
+    the suggestion path can be benchmarked without running a sync first.
+    """
+    # db reads SUPABASE_URL on import, after the stand-ins are configured
+    from db import compact_columns, product_row
+
+    rng = np.random.default_rng(seed)
+    descriptions = random_embeddings(len(products), dim, rng)
+    product_rows, variant_rows = [], []
+    for product, embedding in zip(products, descriptions):
+        product_rows.append(
+            product_row(shop, product, embedding, product["productType"])
+        )
+        edges = product["variants"]["edges"]
+        for edge, image_embedding in zip(
+            edges, random_embeddings(len(edges), dim, rng)
+        ):
+            variant_rows.append(
+                {
+                    "product_id": product["id"],
+                    "variant_id": edge["node"]["id"],
+                    "content": edge["node"],
+                    "image_embedding": image_embedding,
+                    "image_fingerprint": None,
+                    **compact_columns("image_embedding", image_embedding),
+                }
+            )
+    return product_rows, variant_rows
+
+
+def image_bytes(name, size=64):
+    """A PNG of random pixels, deterministic per name"""
+    rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+    pixels = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
@@ -0,0 +1,242 @@
+"""LLM product categorisation and tagging script."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+from pydantic import BaseModel, conlist
+
+from async_runtime import run_blocking_io, shared
+from metrics import ERRORS, IN_FLIGHT, STAGE_SECONDS, count_cache
+
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o")
+# Maximum OpenAI requests in flight per event loop, shared by every sync,
+# webhook batch and tagging call running on it
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 8))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 5))
+# sqlite file holding categories and tags keyed by product content hash
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite3")
+
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+
+
+class TagResponse(BaseModel):
+    """tag response model"""
+
+    occasionTags: conlist(str, min_length=1)  # type: ignore
+    seasonalTags: conlist(str, min_length=1)  # type: ignore
+    styleTags: conlist(str, min_length=1)  # type: ignore
+    descriptionAnalysis: conlist(str, min_length=1)  # type: ignore
+    colourAndTone: conlist(str, min_length=1)  # type: ignore
+    productCategory: str
+
+
+def category_prompt(product):
+    """Prompt asking for the category of a product"""
+    return (
+        "Categorize a product given the title and description.\n"
+        "The response should be a JSON object with a single field: productCategory (string).\n"
+        f"Product info: {product['title']} - {product['description']}"
+    )
+
+
+def tags_prompt(product_content):
+    """Prompt asking for matching tags of a product"""
+    return f"""
+    Your job is to generate a json object of tags and information regarding a product to be used later on for matching outfits of different products together.
+    The object should contain the following fields: occasionTags (string array), seasonalTags: (string array), styleTags (string array), descriptionAnalysis (string array), colourAndTone (string array), productCategory (string).
+    Here is a breakdown of the following fields:
+    - occasionTags: A string array of tags that denote the occasion (e.g., “office,” “casual,” “date night”).
+    - seasonalTags: A string array of tags related to the season (e.g., “summer,” “winter”).
+    - styleTags: A string array of tags that indicate the style (e.g., “boho,” “classic,” “modern”).
+    - descriptionAnalysis: A string array of keywords from item descriptions to understand additional attributes like material, fit, and special features (e.g., “stretchy,” “lightweight”). Do not include information regarding clothing material percentages or cleaning instructions here.
+    - colourAndTone: A string array of tags regarding the products color and tone. (e.g., "Neutral", "Neon", "Purple", Beige", "Red", etc...). Make sure you add at least one tag regarding tone in addition to the colour tags.
+    - productCategory: A string of the product category (e.g., "Dress", "Shorts", "Pants", "Bottom", "Accessory", "Top").
+    Here is the product information: {product_content}
+
+    """
+
+
+def content_hash(product):
+    """Hash of the product fields the LLM answers depend on"""
+    content = f"{LLM_MODEL}\0{product.get('title')}\0{product.get('description')}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Persistent sqlite cache of LLM answers keyed by (kind, content hash)"""
+
+    def __init__(self, path=LLM_CACHE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "kind TEXT, hash TEXT, value TEXT, PRIMARY KEY (kind, hash))"
+        )
+        self._conn.commit()
+
+    def get(self, kind, key):
+        """Return the cached value or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM llm_cache WHERE kind = ? AND hash = ?", (kind, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, kind, keys):
+        """Return the cached value or None of every key"""
+        return [self.get(kind, key) for key in keys]
+
+    def set(self, kind, key, value):
+        """Store a value"""
+        self.set_many(kind, [(key, value)])
+
+    def set_many(self, kind, items):
+        """Store (key, value) pairs in one commit"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO llm_cache (kind, hash, value) VALUES (?, ?, ?)",
+                [(kind, key, json.dumps(value)) for key, value in items],
+            )
+            self._conn.commit()
+
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying, honouring Retry-After when present"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return min(60, 2**attempt) + random.random()
+
+
+class Categorizer:
+    """Concurrent, cached product categorisation and tagging.
+
+    ``client`` is any object exposing an async ``chat.completions.create``,
+    so a local stub can replace OpenAI offline.
+    """
+
+    def __init__(self, client=None, cache=None, concurrency=LLM_CONCURRENCY):
+        self.client = client
+        self.cache = cache
+        self.concurrency = concurrency
+
+    def _cache(self):
+        if self.cache is None:
+            self.cache = LLMCache()
+        return self.cache
+
+    async def _complete(self, client, semaphore, prompt):
+        """Run a JSON chat completion, retrying rate limits and transient errors"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with semaphore:
+                    llm_call = STAGE_SECONDS.time(stage="llm")
+                    with IN_FLIGHT.track_inprogress(operation="llm"), llm_call:
+                        response = await client.chat.completions.create(
+                            model=LLM_MODEL,
+                            response_format={"type": "json_object"},
+                            messages=[{"role": "system", "content": prompt}],
+                        )
+                return json.loads(response.choices[0].message.content or "{}")
+            except RETRYABLE_ERRORS as e:
+                ERRORS.inc(stage="llm")
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                delay = retry_delay(e, attempt)
+                logging.warning("OpenAI request failed (%s), retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+
+    async def _run(self, kind, products, answer):
+        """Answer every product, only calling the LLM for uncached content"""
+        # sqlite reads and commits run off the shared event loop
+        cache = await run_blocking_io(self._cache)
+        keys = [content_hash(product) for product in products]
+        results = await run_blocking_io(cache.get_many, kind, keys)
+
+        # Identical content is only sent once
+        pending = {}
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                pending.setdefault(key, []).append(i)
+        count_cache("llm", len(products) - len(pending), len(pending))
+        if not pending:
+            return results
+
+        # One pooled client per event loop, reused across calls
+        client = self.client or shared(
+            "openai", lambda: AsyncOpenAI(api_key=os.environ.get("OPEN_API_KEY"))
+        )
+        semaphore = shared("llm_semaphore", lambda: asyncio.Semaphore(self.concurrency))
+        answers = await asyncio.gather(
+            *[
+                answer(client, semaphore, products[positions[0]])
+                for positions in pending.values()
+            ]
+        )
+        answered = []
+        for (key, positions), value in zip(pending.items(), answers):
+            if value is not None:
+                answered.append((key, value))
+            for i in positions:
+                results[i] = value
+        await run_blocking_io(cache.set_many, kind, answered)
+        logging.info(
+            "%s: %d cached, %d requested", kind, len(products) - len(pending), len(pending)
+        )
+        return results
+
+    async def _category(self, client, semaphore, product):
+        try:
+            response = await self._complete(client, semaphore, category_prompt(product))
+            return response.get("productCategory")
+        except Exception as e:
+            ERRORS.inc(stage="llm")
+            logging.error(
+                "Error fetching product category for %s: %s", product["title"], e
+            )
+            return None
+
+    async def _tags(self, client, semaphore, product):
+        product_id = product.get("id")
+        try:
+            tags = await self._complete(client, semaphore, tags_prompt(product))
+            validated_tags = TagResponse(**tags)
+            logging.debug("Validated tags: %s for product %s", validated_tags, product_id)
+            return tags
+        except Exception as e:
+            ERRORS.inc(stage="llm")
+            logging.error("Error generating or validating tags %s: %s", product_id, e)
+            return None
+
+    async def categories(self, products):
+        """Return the category of every product, None where it failed"""
+        return await self._run("category", products, self._category)
+
+    async def tags(self, products):
+        """Return the tags of every product, {} where they failed"""
+        return [t or {} for t in await self._run("tags", products, self._tags)]
+
+
+categorizer = Categorizer()
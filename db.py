@@ -2,7 +2,10 @@
 
 import os
 import logging
+import time
 from supabase import create_client
+from embedding_codec import compact_enabled, encode
+from metrics import ERRORS, STAGE_SECONDS
 
 key = os.environ.get("SUPABASE_ANON_KEY")
 url = os.environ.get("SUPABASE_URL")
@@ -35,109 +38,167 @@ def update_app_setup(shop_url, status):
         logging.error("Database operation failed: %s", e)
         raise
 
-def product_exists(product_id: str) -> bool:
-    """Check if a product exists in Supabase by product_id."""
-    try:
-        response = (
-            supabase_client.table("products")
-            .select("product_id")
-            .eq("product_id", product_id)
-            .limit(1)
-            .execute()
-        )
-        return len(response.data) > 0
-
-    except Exception as e:
-        logging.error("Database operation failed: %s", e)
-        raise
+# Rows buffered by BulkWriter before an upsert, and max seconds between flushes
+DB_FLUSH_SIZE = int(os.environ.get("DB_FLUSH_SIZE", 200))
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", 10))
+# Variant rows per upsert request; each carries a full image embedding
+DB_VARIANT_CHUNK_SIZE = int(os.environ.get("DB_VARIANT_CHUNK_SIZE", 250))
 
 
-def upsert_variants(product_id: str, variant_data: list):
-    """Insert product variants into the 'variants' table."""
+def upsert_variants(variant_data: list):
+    """Upsert product variants into the 'variants' table."""
     try:
         _ = (
             supabase_client.table("variants")
-            .upsert(variant_data, on_conflict=["variant_id"])
+            .upsert(variant_data, on_conflict="variant_id")
             .execute()
         )
-
-        print(f"Variants for product {product_id} inserted successfully")
-
     except Exception as e:
         logging.error("Database operation failed: %s", e)
         raise
 
-def create_product(shop, product, text_embeddings, item_type, variant_data):
-    """Create a product in Supabase."""
-    try:
-        content = {
-            "title": product["title"],
-            "description": product["description"],
-            "onlineStoreUrl": product["onlineStoreUrl"],
-            "featureImage": product["featuredImage"]["url"],
-            "priceRange": product["priceRange"],
-        }
 
-        # Insert product into 'products' table
-        _= (
+def fetch_fingerprints(product_ids: list) -> dict:
+    """Return {product_id: fingerprint} of the given products already stored."""
+    if not product_ids:
+        return {}
+    try:
+        response = (
             supabase_client.table("products")
-            .insert(
-                {
-                    "shop": shop,
-                    "product_id": product["id"],
-                    "content": content,
-                    "description_embedding": text_embeddings,
-                    "product_type": item_type.lower(),
-                }
-            )
+            .select("product_id, fingerprint")
+            .in_("product_id", product_ids)
             .execute()
         )
-
-        print(f"Product {product['id']} inserted successfully")
-
-        if variant_data:
-            upsert_variants(product["id"], variant_data)
-
+        return {row["product_id"]: row["fingerprint"] for row in response.data}
     except Exception as e:
         logging.error("Database operation failed: %s", e)
         raise
 
 
-def update_product(shop, product, text_embeddings, item_type, variant_data):
-    """Update product in Supabase"""
+def fetch_variant_images(product_ids: list) -> dict:
+    """Return {variant_id: (image_fingerprint, image_embedding)} of stored variants."""
+    if not product_ids:
+        return {}
     try:
-        content = {
-            "title": product["title"],
-            "description": product["description"],
-            "onlineStoreUrl": product["onlineStoreUrl"],
-            "featureImage": product["featuredImage"]["url"],
-            "priceRange": product["priceRange"],
-        }
-        print(content)
-        variant_data = variant_data if variant_data else []
-
-        # Prepare the update data
-        update_data = {
-            "shop": shop,
-            "content": content,
-            "description_embedding": text_embeddings,
-            "product_type": item_type.lower(),
-        }
-
-        # Execute the update
-        _ = (
-            supabase_client.table("products")
-            .update(update_data)
-            .eq("product_id", product["id"])
+        response = (
+            supabase_client.table("variants")
+            .select("variant_id, image_fingerprint, image_embedding")
+            .in_("product_id", product_ids)
             .execute()
         )
-
-        print(f"Product {product['id']} updated successfully")
-
-        # Handle variants update (if required)
-        if variant_data:
-            upsert_variants(product["id"], variant_data)
-
+        return {
+            row["variant_id"]: (row["image_fingerprint"], row["image_embedding"])
+            for row in response.data
+        }
     except Exception as e:
         logging.error("Database operation failed: %s", e)
         raise
+
+
+def product_row(shop, product, text_embeddings, item_type, fingerprint=None):
+    """Build the 'products' row for a Shopify product."""
+    content = {
+        "title": product["title"],
+        "description": product["description"],
+        "onlineStoreUrl": product["onlineStoreUrl"],
+        "featureImage": product["featuredImage"]["url"],
+        "priceRange": product["priceRange"],
+    }
+    return {
+        "shop": shop,
+        "product_id": product["id"],
+        "content": content,
+        "description_embedding": text_embeddings,
+        "product_type": item_type.lower() if item_type else None,
+        "fingerprint": fingerprint,
+        **compact_columns("description_embedding", text_embeddings),
+    }
+
+
+def compact_columns(column, embedding):
+    """The compact ``<column>_q`` copy of an embedding, when enabled."""
+    if not compact_enabled():
+        return {}
+    return {f"{column}_q": encode(embedding) if embedding else None}
+
+
+class BulkWriter:
+    """Buffer products and variants and upsert them in chunks.
+
+    Products are flushed before their variants, once ``flush_size`` products
+    are buffered or ``flush_interval`` seconds passed since the last flush;
+    variants are upserted in requests of at most ``variant_chunk_size`` rows.
+    Use as a context manager so the remainder is flushed at the end.
+    """
+
+    def __init__(
+        self,
+        flush_size=DB_FLUSH_SIZE,
+        flush_interval=DB_FLUSH_INTERVAL,
+        variant_chunk_size=DB_VARIANT_CHUNK_SIZE,
+    ):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.variant_chunk_size = variant_chunk_size
+        self.products = []
+        self.variants = []
+        self.written = 0
+        # Stream positions recorded with mark(); everything up to
+        # ``durable`` has been upserted
+        self.position = 0
+        self.durable = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    @property
+    def pending(self):
+        """Number of buffered products"""
+        return len(self.products)
+
+    def add(
+        self, shop, product, text_embeddings, item_type, variant_data, fingerprint=None
+    ):
+        """Buffer a product and its variants, flushing when a limit is reached"""
+        self.products.append(
+            product_row(shop, product, text_embeddings, item_type, fingerprint)
+        )
+        for variant in variant_data or []:
+            compact = compact_columns("image_embedding", variant["image_embedding"])
+            self.variants.append({**variant, **compact})
+        if (
+            len(self.products) >= self.flush_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def mark(self, position):
+        """Record that every product up to stream ``position`` has been added"""
+        self.position = position
+        if not self.products:
+            self.durable = position
+
+    def flush(self):
+        """Upsert all buffered rows"""
+        if self.products:
+            with STAGE_SECONDS.time(stage="db_write"), ERRORS.count_exceptions(
+                stage="db_write"
+            ):
+                upsert_data(self.products, "products")
+                for i in range(0, len(self.variants), self.variant_chunk_size):
+                    upsert_variants(self.variants[i : i + self.variant_chunk_size])
+            logging.info(
+                "Upserted %d products and %d variants",
+                len(self.products),
+                len(self.variants),
+            )
+            self.written += len(self.products)
+        self.durable = self.position
+        self.products = []
+        self.variants = []
+        self.last_flush = time.monotonic()
@@ -0,0 +1,53 @@
+"""compact embedding storage format."""
+
+import base64
+import os
+
+import numpy as np
+
+# "float32" keeps JSON float lists only; "float16" or "int8" also write the
+# compact base64 columns (description_embedding_q, image_embedding_q)
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "float32")
+# Read the catalog from the compact columns only; turn on once
+# migrate_embeddings.py has backfilled them for every existing row
+READ_COMPACT_EMBEDDINGS = os.environ.get("READ_COMPACT_EMBEDDINGS", "0") == "1"
+
+# First byte of an encoded vector
+FORMATS = {"float16": 1, "int8": 2}
+
+
+def encode(vector, fmt=None):
+    """Encode a vector as base64 float16, or int8 with a float32 scale"""
+    fmt = fmt or EMBEDDING_STORAGE
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    if fmt == "float16":
+        payload = vector.astype("<f2").tobytes()
+    elif fmt == "int8":
+        scale = float(np.abs(vector).max()) / 127 if vector.size else 0.0
+        scale = scale or 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        payload = np.float32(scale).astype("<f4").tobytes() + quantized.tobytes()
+    else:
+        raise ValueError(f"Unknown embedding storage format: {fmt}")
+    return base64.b64encode(bytes([FORMATS[fmt]]) + payload).decode("ascii")
+
+
+def decode(data):
+    """Decode an encoded vector; float16 is returned as a zero-copy view"""
+    raw = base64.b64decode(data)
+    if raw[0] == FORMATS["float16"]:
+        return np.frombuffer(raw, dtype="<f2", offset=1)
+    if raw[0] == FORMATS["int8"]:
+        scale = np.frombuffer(raw, dtype="<f4", count=1, offset=1)[0]
+        return np.frombuffer(raw, dtype=np.int8, offset=5) * scale
+    raise ValueError(f"Unknown embedding format byte: {raw[0]}")
+
+
+def compact_enabled():
+    """Whether compact embedding columns are written"""
+    return EMBEDDING_STORAGE in FORMATS
+
+
+def compact_reads_enabled():
+    """Whether the catalog is read from the compact columns"""
+    return READ_COMPACT_EMBEDDINGS
@@ -0,0 +1,484 @@
+"""in-process embedding index for product suggestions."""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_codec import decode
+from metrics import count_cache
+
+INDEX_TTL = float(os.environ.get("EMBEDDING_INDEX_TTL", 300))
+# Display rows (content and variants) of recommended products kept per process
+DETAILS_CACHE_SIZE = int(os.environ.get("DETAILS_CACHE_SIZE", 5000))
+# Product ids per details query; the ids are sent in the URL, which
+# PostgREST and proxies limit in length
+DETAILS_QUERY_SIZE = int(os.environ.get("DETAILS_QUERY_SIZE", 50))
+# Catalogs with at least this many variants switch to approximate search
+ANN_MIN_VARIANTS = int(os.environ.get("ANN_MIN_VARIANTS", 20000))
+# Number of IVF lists scanned per query; higher means better recall, slower
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 16))
+# Per-shop overrides, format: "shop-a.myshopify.com:ivf,shop-b.myshopify.com:exact"
+ANN_SHOP_MODES = dict(
+    entry.strip().rsplit(":", 1)
+    for entry in os.environ.get("ANN_SHOP_MODES", "").split(",")
+    if ":" in entry
+)
+
+
+def as_vector(value):
+    """Convert a stored embedding to a float32 vector, or None if unusable"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        # JSON float list, or a compact base64 vector from embedding_codec
+        value = json.loads(value) if value.startswith("[") else decode(value)
+    vector = np.asarray(value, dtype=np.float32).ravel()
+    if vector.size == 0:
+        return None
+    return vector
+
+
+def normalize(vectors):
+    """L2-normalize a vector or the rows of a matrix"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Return the positions of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def search_mode(shop, size):
+    """Pick "exact" or "ivf" search for a shop's catalog of ``size`` variants"""
+    mode = ANN_SHOP_MODES.get(shop, "auto")
+    if mode == "auto":
+        return "ivf" if size >= ANN_MIN_VARIANTS else "exact"
+    return mode
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index over a vector matrix.
+
+    Vectors are clustered with spherical k-means; a query only scores the
+    vectors of the ``nprobe`` clusters whose centroids match it best.
+    """
+
+    def __init__(self, vectors, nlist=None, iterations=10, seed=0):
+        self.vectors = vectors
+        size = len(vectors)
+        nlist = nlist or max(1, int(np.sqrt(size)))
+        nlist = min(nlist, size)
+        rng = np.random.default_rng(seed)
+        unit = normalize(vectors)
+
+        # Train centroids on a sample, then assign every vector once
+        sample = unit
+        if size > 40 * nlist:
+            sample = unit[rng.choice(size, 40 * nlist, replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~np.any(sums, axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+        self.centroids = np.ascontiguousarray(centroids)
+
+        assignment = np.argmax(unit @ self.centroids.T, axis=1)
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(nlist + 1))
+
+    def candidates(self, query, nprobe=ANN_NPROBE):
+        """Return the positions of the vectors in the lists closest to the query"""
+        probe = top_k(self.centroids @ query, nprobe)
+        return np.concatenate(
+            [self.order[self.offsets[c] : self.offsets[c + 1]] for c in probe]
+        )
+
+    def search(self, query, k, nprobe=ANN_NPROBE):
+        """Return (positions, scores) of the approximate top-k vectors"""
+        candidates = self.candidates(query, nprobe)
+        scores = self.vectors[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+
+class TypeIndex:
+    """Embeddings of one (shop, product_type), scored with a single matvec.
+
+    Each row of ``vectors`` is ``(text + image) / 2`` of the pre-normalized
+    product description and variant image embeddings, so ``vectors @ query``
+    for a normalized query is exactly the average of both cosine similarities.
+    Only ids are kept next to the matrix; display fields are fetched for
+    the selected results by ProductDetails.
+    """
+
+    def __init__(self, products, mode="exact"):
+        self.products = []
+        self.variant_ids = []
+        self.variant_product = []
+        rows = []
+        for product in products:
+            text = as_vector(
+                product.get("description_embedding_q")
+                or product.get("description_embedding")
+            )
+            if text is None or not np.any(text):
+                continue
+            text = normalize(text)
+            product_index = len(self.products)
+            added = False
+            for variant in product.get("variants") or []:
+                image = as_vector(
+                    variant.get("image_embedding_q") or variant.get("image_embedding")
+                )
+                if image is None or image.shape != text.shape or not np.any(image):
+                    continue
+                rows.append((text + normalize(image)) / 2)
+                self.variant_ids.append(variant["variant_id"])
+                self.variant_product.append(product_index)
+                added = True
+            if added:
+                self.products.append(
+                    {
+                        "product_id": product["product_id"],
+                        "product_type": product["product_type"],
+                    }
+                )
+
+        self.variant_product = np.asarray(self.variant_product, dtype=np.int32)
+        # Variants are stored grouped by product; product i owns
+        # positions product_bounds[i]:product_bounds[i + 1]
+        self.product_bounds = np.searchsorted(
+            self.variant_product, np.arange(len(self.products) + 1)
+        )
+        if rows:
+            self.vectors = np.ascontiguousarray(np.vstack(rows), dtype=np.float32)
+        else:
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.ivf = None
+        if mode == "ivf" and rows:
+            self.ivf = IVFIndex(self.vectors)
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.variant_ids)
+
+    def score(self, query):
+        """Return the aggregated similarity of every variant to the query"""
+        return self.vectors @ normalize(np.ravel(query))
+
+    def search(self, query, k=1, dedupe=False):
+        """Return (positions, similarities) of the k most similar variants"""
+        query = normalize(np.ravel(query))
+        if self.ivf is not None:
+            return self.search_ivf(query, k, dedupe)
+        return self.top_variants(self.vectors @ query, k, dedupe)
+
+    def top_variants(self, scores, k, dedupe=False):
+        """Select the top-k of a full score vector, best first.
+
+        With ``dedupe`` only the best variant of each product is eligible.
+        """
+        if not dedupe:
+            best = top_k(scores, k)
+            return best, scores[best]
+        product_scores = np.maximum.reduceat(scores, self.product_bounds[:-1])
+        positions = []
+        for product in top_k(product_scores, k):
+            low, high = self.product_bounds[product : product + 2]
+            positions.append(low + int(np.argmax(scores[low:high])))
+        positions = np.asarray(positions, dtype=np.int64)
+        return positions, scores[positions]
+
+    def search_ivf(self, query, k, dedupe=False):
+        """Approximate top-k over the probed lists.
+
+        With ``dedupe`` the best variant of every probed product is ranked,
+        so k products are returned whenever the lists hold that many.
+        """
+        if not dedupe:
+            return self.ivf.search(query, k)
+        candidates = self.ivf.candidates(query)
+        scores = self.vectors[candidates] @ query
+        # Best first, so the first occurrence of a product is its best variant
+        order = np.argsort(-scores, kind="stable")
+        _, first = np.unique(self.variant_product[candidates[order]], return_index=True)
+        best = order[first]
+        best = best[top_k(scores[best], k)]
+        return candidates[best], scores[best]
+
+    def result(self, position, similarity):
+        """Build the recommendation dict of the variant at ``position``, without
+        display fields (see ProductDetails.hydrate)"""
+        product = self.products[self.variant_product[position]]
+        return {
+            "product_id": product["product_id"],
+            "variant_id": self.variant_ids[position],
+            "similarity": float(similarity),
+            "item_type": product["product_type"],
+        }
+
+
+def search_batch(type_indexes, queries, query_types, k=1, dedupe=False):
+    """Search several queries, each restricted to its own product type.
+
+    Exact-mode queries are scored against the stacked catalogs of all their
+    types in one matrix product; each query then only reads the columns of
+    its own type, which are contiguous. IVF-mode types are searched per query.
+    With ``dedupe`` each product contributes at most one variant. Returns a
+    list of (positions, similarities) aligned with ``queries``.
+    """
+    queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+    results = [empty] * len(queries)
+
+    blocks, offsets, exact_rows = [], {}, []
+    width = 0
+    for row, product_type in enumerate(query_types):
+        type_index = type_indexes[product_type]
+        if not len(type_index):
+            continue
+        if type_index.ivf is not None:
+            results[row] = type_index.search_ivf(queries[row], k, dedupe)
+            continue
+        if product_type not in offsets:
+            offsets[product_type] = (width, width + len(type_index))
+            blocks.append(type_index.vectors)
+            width += len(type_index)
+        exact_rows.append(row)
+
+    if exact_rows:
+        matrix = blocks[0] if len(blocks) == 1 else np.vstack(blocks)
+        scores = queries[exact_rows] @ matrix.T
+        for scores_row, row in zip(scores, exact_rows):
+            low, high = offsets[query_types[row]]
+            type_index = type_indexes[query_types[row]]
+            results[row] = type_index.top_variants(scores_row[low:high], k, dedupe)
+    return results
+
+
+class ProductDetails:
+    """Bounded, TTL-refreshed LRU cache of product display rows.
+
+    ``loader(shop, product_ids)`` returns rows with ``product_id``,
+    ``content`` and ``variants`` (``variant_id`` and ``content`` each); only
+    the products of returned recommendations are ever loaded.
+    """
+
+    def __init__(
+        self,
+        loader,
+        ttl=INDEX_TTL,
+        size=DETAILS_CACHE_SIZE,
+        query_size=DETAILS_QUERY_SIZE,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.size = size
+        self.query_size = query_size
+        self._entries = OrderedDict()  # (shop, product_id) -> (loaded_at, row)
+        self._lock = threading.Lock()
+
+    async def get_many(self, shop, product_ids):
+        """Return {product_id: row}, loading missing products in concurrent queries"""
+        rows = {}
+        now = time.monotonic()
+        with self._lock:
+            for product_id in dict.fromkeys(product_ids):
+                entry = self._entries.get((shop, product_id))
+                if entry is not None and now - entry[0] < self.ttl:
+                    self._entries.move_to_end((shop, product_id))
+                    rows[product_id] = entry[1]
+        missing = [
+            product_id
+            for product_id in dict.fromkeys(product_ids)
+            if product_id not in rows
+        ]
+        count_cache("product_details", len(rows), len(missing))
+        if not missing:
+            return rows
+
+        chunks = await asyncio.gather(
+            *(
+                self.loader(shop, missing[i : i + self.query_size])
+                for i in range(0, len(missing), self.query_size)
+            )
+        )
+        with self._lock:
+            for row in itertools.chain.from_iterable(chunks):
+                rows[row["product_id"]] = row
+                self._entries[(shop, row["product_id"])] = (now, row)
+                self._entries.move_to_end((shop, row["product_id"]))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return rows
+
+    async def hydrate(self, shop, recommendations):
+        """Add ``product_content`` and ``variants`` to recommendation dicts.
+
+        ``recommendations`` holds dicts, None, or lists of dicts, as returned
+        by recommend_outfits_batch; the dicts are updated in place.
+        """
+        results = []
+        for entry in recommendations:
+            if isinstance(entry, list):
+                results.extend(entry)
+            elif entry is not None:
+                results.append(entry)
+        if not results:
+            return recommendations
+        rows = await self.get_many(shop, [result["product_id"] for result in results])
+        for result in results:
+            row = rows.get(result["product_id"]) or {}
+            result["product_content"] = row.get("content")  # Full product details
+            result["variants"] = row.get("variants") or []
+        return recommendations
+
+    def invalidate(self, shop):
+        """Drop the cached rows of a shop"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == shop]:
+                del self._entries[key]
+
+
+class EmbeddingIndex:
+    """Lazily loaded, TTL-refreshed TypeIndex cache keyed by (shop, product_type).
+
+    Concurrent requests for a stale key share one load: the first starts it
+    and the others await its future. ``details_loader`` backs the ``details``
+    cache of display rows, which is invalidated together with the indexes.
+    """
+
+    def __init__(self, loader, ttl=INDEX_TTL, details_loader=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.details = ProductDetails(details_loader, ttl)
+        self._entries = {}
+        self._loading = {}  # (shop, product_type) -> Future of the TypeIndex
+        self._generations = {}  # shop -> number of invalidations
+        self._lock = threading.Lock()
+
+    def _fresh(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl:
+            return entry
+        return None
+
+    async def get(self, shop, product_type):
+        """Return the index for a shop and product type, loading it if stale"""
+        return (await self.get_many(shop, [product_type]))[product_type]
+
+    async def get_many(self, shop, product_types):
+        """Return {product_type: TypeIndex}, loading all stale types in one query"""
+        indexes = {}
+        stale = []
+        for product_type in dict.fromkeys(product_types):
+            entry = self._fresh((shop, product_type))
+            if entry is not None:
+                indexes[product_type] = entry
+            else:
+                stale.append(product_type)
+        count_cache("embedding_index", len(indexes), len(stale))
+        if not stale:
+            return indexes
+
+        loop = asyncio.get_running_loop()
+        waiting, futures = {}, {}
+        with self._lock:
+            for product_type in stale:
+                future = self._loading.get((shop, product_type))
+                # Futures can only be awaited on the loop that created them
+                if future is not None and future.get_loop() is loop:
+                    waiting[product_type] = future
+                else:
+                    futures[product_type] = self._loading[(shop, product_type)] = (
+                        loop.create_future()
+                    )
+            generation = self._generations.get(shop, 0)
+        if futures:
+            await self._load(shop, futures, generation)
+        for product_type, future in {**futures, **waiting}.items():
+            indexes[product_type] = await future
+        return indexes
+
+    async def _load(self, shop, futures, generation):
+        """Load the indexes of ``futures``' product types and resolve them"""
+        start = time.monotonic()
+        try:
+            grouped = {product_type: [] for product_type in futures}
+            for product in await self.loader(shop, list(futures)):
+                grouped.setdefault(product["product_type"], []).append(product)
+            for product_type, future in futures.items():
+                products = grouped[product_type]
+                size = sum(len(product.get("variants") or []) for product in products)
+                # Decoding and stacking large catalogs is CPU-bound
+                entry = await asyncio.to_thread(
+                    TypeIndex, products, search_mode(shop, size)
+                )
+                with self._lock:
+                    # Not cached if the shop was invalidated during the load
+                    if self._generations.get(shop, 0) == generation:
+                        self._entries[(shop, product_type)] = entry
+                future.set_result(entry)
+                logging.info(
+                    "Loaded %s embedding index for %s/%s: %d variants",
+                    "ivf" if entry.ivf is not None else "exact",
+                    shop,
+                    product_type,
+                    len(entry),
+                )
+        except BaseException as e:
+            for future in futures.values():
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Raised here; waiters, if any, get it from the future
+                    future.exception()
+            raise
+        finally:
+            with self._lock:
+                for product_type, future in futures.items():
+                    if self._loading.get((shop, product_type)) is future:
+                        del self._loading[(shop, product_type)]
+        logging.info(
+            "Loaded %d embedding indexes for %s in %.2fs",
+            len(futures),
+            shop,
+            time.monotonic() - start,
+        )
+
+    def invalidate(self, shop, product_type=None):
+        """Drop cached indexes for a shop, or for one of its product types"""
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == shop and product_type in (None, key[1]):
+                    del self._entries[key]
+            # Loads in flight are not cached, nor shared with later requests
+            self._generations[shop] = self._generations.get(shop, 0) + 1
+            for key in list(self._loading):
+                if key[0] == shop:
+                    del self._loading[key]
+        self.details.invalidate(shop)
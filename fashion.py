@@ -1,45 +1,122 @@
-import aiohttp
-from fashion_clip.fashion_clip import FashionCLIP
+import asyncio
 from PIL import Image
 import io
+import logging
 from supabase import create_client, Client
 import requests
-import numpy as np
-from scipy.spatial.distance import cosine
+from requests.adapters import HTTPAdapter
 import time
-from concurrent.futures import ThreadPoolExecutor
-import asyncio
-import urllib.parse
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
+from async_runtime import http_session
+from batcher import MicroBatcher
+from embedding_codec import compact_reads_enabled
+from embedding_index import EmbeddingIndex, search_batch
+from image_cache import content_hash, image_cache
+from metrics import ERRORS, STAGE_SECONDS
+from models import FINETUNED_MODEL, get_model
+from query_cache import query_cache
 
 # Load environment variables from .env file
 load_dotenv()
 
 key = os.environ.get("SUPABASE_ANON_KEY")
 url = os.environ.get("SUPABASE_URL")
+# Concurrent image downloads and FashionCLIP image batch size during sync
+IMAGE_FETCH_WORKERS = int(os.environ.get("IMAGE_FETCH_WORKERS", 16))
+IMAGE_BATCH_SIZE = int(os.environ.get("IMAGE_BATCH_SIZE", 32))
+# FashionCLIP text batch size for product descriptions during sync
+TEXT_BATCH_SIZE = int(os.environ.get("TEXT_BATCH_SIZE", 64))
 
-model = FashionCLIP("justin-shopcapsule/screenshot-fashion-clip-finetuned")
 supabase: Client = create_client(url, key)
+# Pooled keep-alive connections to image CDNs, shared by every download
+image_session = requests.Session()
+image_session.mount(
+    "https://", HTTPAdapter(pool_connections=8, pool_maxsize=IMAGE_FETCH_WORKERS)
+)
+image_session.mount(
+    "http://", HTTPAdapter(pool_connections=8, pool_maxsize=IMAGE_FETCH_WORKERS)
+)
+
+
+# Scoring only needs ids and embeddings; once the compact columns are
+# backfilled only the base64 embedding columns are transferred
+if compact_reads_enabled():
+    CATALOG_COLUMNS = (
+        "product_id, product_type, description_embedding_q, "
+        "variants(variant_id, image_embedding_q)"
+    )
+else:
+    CATALOG_COLUMNS = (
+        "product_id, product_type, description_embedding, "
+        "variants(variant_id, image_embedding)"
+    )
+# Display fields, only fetched for the products that are recommended
+DETAIL_COLUMNS = "product_id, content, variants(variant_id, content)"
+
+
+def quote_list(values):
+    """PostgREST ``in`` filter list, e.g. ("a","b"), with ``"`` and ``\\`` escaped"""
+    quoted = (
+        '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for value in values
+    )
+    return "(" + ",".join(quoted) + ")"
 
 
-async def fetch_embeddings_async(shop, item_type):
-    """Make asynchronous HTTP requests using aiohttp, or async database queries"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"https://ugbtvxiaydwqsjspaghc.supabase.co/rest/v1/products?select=%2A%2C%20variants%28%2A%29&shop=eq.{urllib.parse.quote_plus(shop)}&product_type=eq.{item_type}&apikey={urllib.parse.quote_plus(key)}"
+async def fetch_embeddings_async(shop, item_types):
+    """Fetch the catalog of every item type for a shop in a single query"""
+    with STAGE_SECONDS.time(stage="catalog_fetch"), ERRORS.count_exceptions(
+        stage="catalog_fetch"
+    ):
+        async with http_session("supabase").get(
+            f"{url}/rest/v1/products",
+            params={
+                "select": CATALOG_COLUMNS,
+                "shop": f"eq.{shop}",
+                "product_type": f"in.{quote_list(item_types)}",
+                "apikey": key,
+            },
         ) as response:
+            response.raise_for_status()
             return await response.json()
 
 
+async def fetch_details_async(shop, product_ids):
+    """Fetch the display fields of some products of a shop in a single query"""
+    with STAGE_SECONDS.time(stage="catalog_details"), ERRORS.count_exceptions(
+        stage="catalog_details"
+    ):
+        async with http_session("supabase").get(
+            f"{url}/rest/v1/products",
+            params={
+                "select": DETAIL_COLUMNS,
+                "shop": f"eq.{shop}",
+                "product_id": f"in.{quote_list(product_ids)}",
+                "apikey": key,
+            },
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+# Per-(shop, product_type) embedding matrices and the display rows of
+# recommended products, shared by all requests
+embedding_index = EmbeddingIndex(
+    fetch_embeddings_async, details_loader=fetch_details_async
+)
+
+
 def generate_embedding(user_input):
     """Generate embedding for user input"""
     # This function should run your model's inference (synchronously)
     start_embedding = time.time()
-    user_embedding = model.encode_text([user_input], batch_size=5)
+    user_embedding = query_cache.encode(FINETUNED_MODEL, [user_input])
     end_embedding = time.time()
-    print(f"encode text ran in {round(end_embedding - start_embedding, 2)}s")
+    logging.debug("encode text ran in %.2fs", end_embedding - start_embedding)
 
     if user_embedding.ndim > 1:
         user_embedding = user_embedding.flatten()
@@ -49,62 +126,176 @@ def generate_embedding(user_input):
 
 async def recommend_outfits_with_embeddings(user_embedding, shop, item_type):
     """Recommend products based on embeddings"""
-    loop = asyncio.get_running_loop()
-
-    with ThreadPoolExecutor() as pool:
-        embeddings = await fetch_embeddings_async(shop, item_type)
-        print(len(embeddings))
-
-    # Calculate cosine similarity between user input and each product embedding
-    recommendations = []
-    for product in embeddings:
-        product_id = product["product_id"]
-        text_embedding = np.array(product["description_embedding"])
-        text_similarity = 1 - cosine(user_embedding, text_embedding)
-
-        for variant in product["variants"]:
-            # Calculate cosine similarity for both image and text embeddings
-            image_embedding = np.array(variant["image_embedding"])
-            image_similarity = 1 - cosine(user_embedding, image_embedding)
-            # Aggregate similarity (you can use an average or weighted sum)
-            aggregated_similarity = (image_similarity + text_similarity) / 2
-
-            recommendations.append(
-                {
-                    "product_id": product_id,
-                    "variant_id": variant["variant_id"],
-                    "similarity": aggregated_similarity,
-                    "product_content": product["content"],  # Full product details
-                    "item_type": product["product_type"],
-                    "variants": product["variants"],
-                }
+    return (await recommend_outfits_batch([user_embedding], shop, [item_type]))[0]
+
+
+async def recommend_outfits_batch(
+    user_embeddings, shop, item_types, k=None, dedupe=False
+):
+    """Recommend products for each (embedding, item_type) pair.
+
+    Without ``k`` each entry is the single best match (or None); with ``k``
+    each entry is a ranked list of up to k matches. ``dedupe`` keeps at most
+    one variant per product.
+    """
+    type_indexes = await embedding_index.get_many(shop, item_types)
+
+    def score():
+        with STAGE_SECONDS.time(stage="scoring"):
+            # One matrix product for every query; large catalogs use IVF
+            matches = search_batch(
+                type_indexes, user_embeddings, item_types, k=k or 1, dedupe=dedupe
             )
+            recommendations = []
+            for item_type, (positions, similarities) in zip(item_types, matches):
+                # Result dicts are only built for the selected variants
+                ranked = [
+                    type_indexes[item_type].result(position, similarity)
+                    for position, similarity in zip(positions, similarities)
+                ]
+                if k is None:
+                    recommendations.append(ranked[0] if ranked else None)
+                else:
+                    recommendations.append(ranked)
+        return recommendations
 
-    # Sort recommendations by similarity (descending order)
-    recommendations = sorted(
-        recommendations, key=lambda x: x["similarity"], reverse=True
-    )
-    return recommendations[0]
+    # Scoring is CPU-bound; keep the shared event loop free for other requests
+    recommendations = await asyncio.to_thread(score)
+    # Display fields of the selected products only, from cache or a few queries
+    return await embedding_index.details.hydrate(shop, recommendations)
 
 
 def get_image_from_url(urlimage):
     """Get image from url and return PIL image"""
-    response = requests.get(urlimage)
-    image = Image.open(io.BytesIO(response.content)).convert("RGB")
-    return image
+    return download_image(urlimage)[1]
+
+
+def download_image(urlimage):
+    """Download an image, return (content hash, PIL image)"""
+    with STAGE_SECONDS.time(stage="image_download"), ERRORS.count_exceptions(
+        stage="image_download"
+    ):
+        response = image_session.get(urlimage, timeout=30)
+        response.raise_for_status()
+        image = Image.open(io.BytesIO(response.content)).convert("RGB")
+    return content_hash(response.content), image
+
+
+def encode_text_batch(descriptions):
+    """Encode a micro-batch of texts for text_batcher"""
+    model = get_model(FINETUNED_MODEL)
+    return model.encode_text(descriptions, len(descriptions)).tolist()
+
+
+def encode_image_batch(images):
+    """Encode a micro-batch of images for image_batcher"""
+    model = get_model(FINETUNED_MODEL)
+    return model.encode_images(images, len(images)).tolist()
+
+
+# Concurrent /embed-text and /embed-image requests share inference batches
+text_batcher = MicroBatcher("embed-text", encode_text_batch)
+image_batcher = MicroBatcher("embed-image", encode_image_batch)
 
 
 def embed_text(description):
     """Embed text and return the embedding"""
-    # Generate text embedding
-    text_embedding = model.encode_text([description], 1).flatten().tolist()
-    print(text_embedding)
-    return text_embedding
+    # Generate text embedding, batched with concurrent callers
+    return text_batcher(description)
+
+
+def embed_texts(descriptions, batch_size=TEXT_BATCH_SIZE):
+    """Embed many texts in batches, return embeddings in input order"""
+    if not descriptions:
+        return []
+    model = get_model(FINETUNED_MODEL)
+    return model.encode_text(list(descriptions), batch_size).tolist()
 
 
 def embed_image(image_url):
     """Embed image and return the embedding"""
-    image = get_image_from_url(image_url)
-    # Generate image embedding
-    image_embedding = model.encode_images([image], 1).flatten().tolist()
+    if image_cache is not None:
+        cached = image_cache.get_by_url(FINETUNED_MODEL, image_url)
+        if cached is not None:
+            return cached
+    digest, image = download_image(image_url)
+    if image_cache is not None:
+        cached = image_cache.get_by_hash(FINETUNED_MODEL, image_url, digest)
+        if cached is not None:
+            return cached
+    # Generate image embedding, batched with concurrent callers
+    image_embedding = image_batcher(image)
+    if image_cache is not None:
+        image_cache.put(FINETUNED_MODEL, image_url, digest, image_embedding)
     return image_embedding
+
+
+def iter_images(image_urls, workers=IMAGE_FETCH_WORKERS, errors=None):
+    """Download and decode images on a thread pool, yield in order
+    (url, (content hash, image)).
+
+    At most ``2 * workers`` downloads are in flight or buffered at once; the
+    second item is None when the download or decode failed, and the error
+    is recorded in ``errors`` if given.
+    """
+    urls = iter(image_urls)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for image_url in urls:
+            pending.append((image_url, pool.submit(download_image, image_url)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            image_url, future = pending.popleft()
+            next_url = next(urls, None)
+            if next_url is not None:
+                pending.append((next_url, pool.submit(download_image, next_url)))
+            try:
+                yield image_url, future.result()
+            except Exception as e:
+                logging.warning("Error downloading image %s: %s", image_url, e)
+                if errors is not None:
+                    errors[image_url] = str(e)
+                yield image_url, None
+
+
+def embed_images(image_urls, batch_size=IMAGE_BATCH_SIZE, errors=None):
+    """Embed many images in batches, return {image_url: embedding}.
+
+    Downloads overlap with inference; failed images are left out and their
+    error recorded in ``errors`` if given. URLs in
+    the persistent image cache are not downloaded, and images whose content
+    is cached under another URL are not re-encoded.
+    """
+    embeddings = {}
+    if image_cache is not None:
+        embeddings = image_cache.get_many_by_url(FINETUNED_MODEL, image_urls)
+    misses = [url for url in dict.fromkeys(image_urls) if url not in embeddings]
+
+    batch = []
+
+    def flush():
+        vectors = get_model(FINETUNED_MODEL).encode_images(
+            [image for _, _, image in batch], batch_size
+        )
+        for (image_url, digest, _), vector in zip(batch, vectors):
+            embeddings[image_url] = vector.tolist()
+            if image_cache is not None:
+                image_cache.put(FINETUNED_MODEL, image_url, digest, vector)
+        batch.clear()
+
+    for image_url, downloaded in iter_images(misses, errors=errors):
+        if downloaded is None:
+            continue
+        digest, image = downloaded
+        if image_cache is not None:
+            cached = image_cache.get_by_hash(FINETUNED_MODEL, image_url, digest)
+            if cached is not None:
+                embeddings[image_url] = cached
+                continue
+        batch.append((image_url, digest, image))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return embeddings
@@ -0,0 +1,15 @@
+"""gunicorn settings."""
+
+import gc
+import os
+
+# Import main.py (which loads PRELOAD_MODELS) once in the master, so forked
+# workers share the model weights copy-on-write instead of loading their own
+preload_app = bool(os.environ.get("PRELOAD_MODELS"))
+# Threads per worker; concurrent /embed-* requests in a worker share batches
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+
+def pre_fork(server, worker):
+    """Keep the garbage collector from touching, and so copying, shared objects"""
+    gc.freeze()
@@ -0,0 +1,216 @@
+"""persistent image embedding cache."""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from async_runtime import after_fork
+from metrics import count_cache
+
+# Directory of the cache; set to an empty string to disable it
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", ".image_cache")
+# Maximum embeddings kept per model before least recently used are evicted
+IMAGE_CACHE_CAPACITY = int(os.environ.get("IMAGE_CACHE_CAPACITY", 200000))
+# Hits are recorded in memory and written to the LRU order in batches, once
+# this many are pending or this many seconds passed
+IMAGE_CACHE_TOUCH_BATCH = int(os.environ.get("IMAGE_CACHE_TOUCH_BATCH", 1000))
+IMAGE_CACHE_TOUCH_INTERVAL = float(os.environ.get("IMAGE_CACHE_TOUCH_INTERVAL", 30))
+# URLs per sqlite query of get_many_by_url
+URL_QUERY_CHUNK = 500
+
+
+def content_hash(data):
+    """sha256 of downloaded image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageEmbeddingCache:
+    """On-disk, size-bounded LRU cache of image embeddings.
+
+    Embeddings are keyed by (model, image content hash) and stored in a
+    memory-mapped float32 matrix per model; a sqlite index maps image URLs
+    to content hashes and hashes to matrix slots. A URL hit skips the
+    download, a content hit (same image at another URL) skips inference.
+    Lookups only read: the index is in WAL mode and hits update the LRU
+    order lazily, in batches.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, capacity=IMAGE_CACHE_CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self._reset()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db = None
+        self._vectors = {}
+        self._touched = {}  # (model, hash) -> time of the last hit
+        self._touched_at = time.monotonic()
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(self.directory, "index.sqlite3"),
+                check_same_thread=False,
+                timeout=30,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                "model TEXT, url TEXT, hash TEXT, PRIMARY KEY (model, url));"
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "model TEXT, hash TEXT, slot INTEGER, dim INTEGER, last_used REAL, "
+                "PRIMARY KEY (model, hash));"
+                "CREATE INDEX IF NOT EXISTS entries_lru ON entries (model, last_used);"
+            )
+        return self._db
+
+    def _matrix(self, model, dim):
+        """Memory-mapped (capacity, dim) float32 matrix of a model"""
+        key = (model, dim)
+        if key not in self._vectors:
+            name = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+            path = os.path.join(self.directory, f"{name}-{dim}.f32")
+            # Another worker may create the file at the same time: open it
+            # without truncating and only ever grow it, so vectors it already
+            # wrote survive
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                size = self.capacity * dim * np.dtype(np.float32).itemsize
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+            self._vectors[key] = np.memmap(
+                path, dtype=np.float32, mode="r+", shape=(self.capacity, dim)
+            )
+        return self._vectors[key]
+
+    def _touch(self, model, digest):
+        """Record a hit; the LRU order is written by _flush_touched"""
+        self._touched[(model, digest)] = time.time()
+        if (
+            len(self._touched) >= IMAGE_CACHE_TOUCH_BATCH
+            or time.monotonic() - self._touched_at >= IMAGE_CACHE_TOUCH_INTERVAL
+        ):
+            self._flush_touched(self._conn)
+            self._conn.commit()
+
+    def _flush_touched(self, conn):
+        conn.executemany(
+            "UPDATE entries SET last_used = ? WHERE model = ? AND hash = ?",
+            [(used, model, digest) for (model, digest), used in self._touched.items()],
+        )
+        self._touched = {}
+        self._touched_at = time.monotonic()
+
+    def _read(self, conn, model, digest):
+        row = conn.execute(
+            "SELECT slot, dim FROM entries WHERE model = ? AND hash = ?",
+            (model, digest),
+        ).fetchone()
+        if row is None:
+            return None
+        self._touch(model, digest)
+        return self._matrix(model, row[1])[row[0]].tolist()
+
+    def get_by_url(self, model, url):
+        """Return the embedding of an image URL seen before, or None"""
+        return self.get_many_by_url(model, [url]).get(url)
+
+    def get_many_by_url(self, model, urls):
+        """Return {url: embedding} of the image URLs seen before"""
+        urls = list(dict.fromkeys(urls))
+        embeddings = {}
+        with self._lock:
+            conn = self._conn
+            for i in range(0, len(urls), URL_QUERY_CHUNK):
+                chunk = urls[i : i + URL_QUERY_CHUNK]
+                rows = conn.execute(
+                    "SELECT urls.url, entries.hash, entries.slot, entries.dim "
+                    "FROM urls JOIN entries ON entries.model = urls.model "
+                    "AND entries.hash = urls.hash WHERE urls.model = ? "
+                    f"AND urls.url IN ({', '.join('?' * len(chunk))})",
+                    (model, *chunk),
+                ).fetchall()
+                for url, digest, slot, dim in rows:
+                    embeddings[url] = self._matrix(model, dim)[slot].tolist()
+                    self._touch(model, digest)
+        count_cache("image_url", len(embeddings), len(urls) - len(embeddings))
+        return embeddings
+
+    def get_by_hash(self, model, url, digest):
+        """Return the embedding of image content seen before, remembering the URL"""
+        with self._lock:
+            conn = self._conn
+            embedding = self._read(conn, model, digest)
+            if embedding is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO urls (model, url, hash) VALUES (?, ?, ?)",
+                    (model, url, digest),
+                )
+                conn.commit()
+        count_cache("image_content", embedding is not None, embedding is None)
+        return embedding
+
+    def put(self, model, url, digest, embedding):
+        """Store an embedding, evicting the least recently used one when full"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Evict by up-to-date recency
+                self._flush_touched(conn)
+                row = conn.execute(
+                    "SELECT slot FROM entries WHERE model = ? AND hash = ?",
+                    (model, digest),
+                ).fetchone()
+                if row is not None:
+                    slot = row[0]
+                else:
+                    slot = self._allocate(conn, model)
+                self._matrix(model, vector.size)[slot] = vector
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (model, hash, slot, dim, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (model, digest, slot, vector.size, time.time()),
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO urls (model, url, hash) VALUES (?, ?, ?)",
+                    (model, url, digest),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _allocate(self, conn, model):
+        """Return a free slot, evicting the least recently used entry if full"""
+        (count,) = conn.execute(
+            "SELECT COUNT(*) FROM entries WHERE model = ?", (model,)
+        ).fetchone()
+        if count < self.capacity:
+            return count
+        digest, slot = conn.execute(
+            "SELECT hash, slot FROM entries WHERE model = ? "
+            "ORDER BY last_used LIMIT 1",
+            (model,),
+        ).fetchone()
+        conn.execute(
+            "DELETE FROM entries WHERE model = ? AND hash = ?", (model, digest)
+        )
+        conn.execute("DELETE FROM urls WHERE model = ? AND hash = ?", (model, digest))
+        return slot
+
+
+image_cache = ImageEmbeddingCache() if IMAGE_CACHE_DIR else None
@@ -0,0 +1,306 @@
+"""background product sync jobs."""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from async_runtime import after_fork, run_async
+from db import update_app_setup
+from metrics import ERRORS, IN_FLIGHT
+from process_product import handle_product_sync
+from shopify import iter_products, iter_products_bulk
+
+# Sync jobs run at the same time per process, and per shop across all
+# worker processes on the host
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", 2))
+SYNC_JOBS_PER_SHOP = int(os.environ.get("SYNC_JOBS_PER_SHOP", 1))
+# Minimum seconds between progress writes to AppSetup.productSyncStatus
+SYNC_PROGRESS_INTERVAL = float(os.environ.get("SYNC_PROGRESS_INTERVAL", 5))
+SYNC_JOBS_PATH = os.environ.get("SYNC_JOBS_PATH", "sync_jobs.sqlite3")
+# How products are read from Shopify: "pages" (paginated GraphQL) or "bulk"
+# (one bulk operation, streamed as JSONL)
+SHOPIFY_INGEST_MODE = os.environ.get("SHOPIFY_INGEST_MODE", "pages")
+
+JOB_FIELDS = (
+    "id",
+    "shop",
+    "status",
+    "cursor",
+    "pages",
+    "embedded",
+    "written",
+    "processed",
+    "skipped",
+    "error",
+    "pid",
+    "pid_started",
+    "created_at",
+    "updated_at",
+)
+
+
+def process_start_time(pid):
+    """Start time of a process in clock ticks since boot, None if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except (OSError, TypeError):
+        return None
+    # Field 22; the command name before it may contain spaces
+    return int(stat.rsplit(b")", 1)[1].split()[19])
+
+
+def process_alive(pid, started=None):
+    """Whether the process that had this pid (and start time) is still running.
+
+    Pids are reused, e.g. by a restarted container's workers, so when the
+    start time is known a different process with the same pid is not alive.
+    """
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    current = process_start_time(pid)
+    return started is None or current is None or current == started
+
+
+class ShopBusy(RuntimeError):
+    """The shop already has as many queued or running syncs as allowed"""
+
+    def __init__(self, shop, job_id):
+        super().__init__(f"A sync of {shop} is already in progress ({job_id})")
+        self.job_id = job_id
+
+
+class JobStore:
+    """sqlite table of sync jobs, shared by every worker process on the host"""
+
+    def __init__(self, path=SYNC_JOBS_PATH):
+        self.path = path
+        self._reset()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._create_table()
+        return self._db
+
+    def _create_table(self):
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sync_jobs ("
+            "id TEXT PRIMARY KEY, shop TEXT, status TEXT, cursor TEXT, "
+            "pages INTEGER DEFAULT 0, embedded INTEGER DEFAULT 0, "
+            "written INTEGER DEFAULT 0, processed INTEGER DEFAULT 0, "
+            "skipped INTEGER DEFAULT 0, error TEXT, pid INTEGER, "
+            "pid_started INTEGER, created_at REAL, updated_at REAL)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sync_jobs)")]
+        if "pid_started" not in columns:
+            self._db.execute("ALTER TABLE sync_jobs ADD COLUMN pid_started INTEGER")
+        self._db.commit()
+
+    def create(self, shop, cursor=None, limit=None):
+        """Insert a queued job and return its id.
+
+        With ``limit``, raises ShopBusy instead if the shop already has that
+        many queued or running jobs in live processes; the check and insert
+        are one transaction, so the limit holds across processes.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if limit is not None:
+                    active = [
+                        row[0]
+                        for row in self._conn.execute(
+                            "SELECT id, pid, pid_started FROM sync_jobs "
+                            "WHERE shop = ? AND status IN ('queued', 'running') "
+                            "ORDER BY created_at",
+                            (shop,),
+                        ).fetchall()
+                        if process_alive(row[1], row[2])
+                    ]
+                    if len(active) >= limit:
+                        raise ShopBusy(shop, active[0])
+                pid = os.getpid()
+                self._conn.execute(
+                    "INSERT INTO sync_jobs (id, shop, status, cursor, pid, "
+                    "pid_started, created_at, updated_at) "
+                    "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                    (job_id, shop, cursor, pid, process_start_time(pid), now, now),
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return job_id
+
+    def update(self, job_id, **fields):
+        """Update job columns"""
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE sync_jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+            self._conn.commit()
+
+    def get(self, job_id):
+        """Return a job as a dict, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM sync_jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        if job["status"] in ("queued", "running") and not process_alive(
+            job["pid"], job["pid_started"]
+        ):
+            job["status"] = "interrupted"
+        return job
+
+    def resume_cursor(self, shop):
+        """Checkpointed cursor of the shop's latest job, if it did not finish"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM sync_jobs WHERE shop = ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (shop,),
+            ).fetchone()
+        job = self.get(row[0]) if row else None
+        if job and job["status"] in ("failed", "interrupted"):
+            return job["cursor"]
+        return None
+
+
+class SyncProgress:
+    """Tracks one job's progress, checkpoints its cursor and publishes status"""
+
+    def __init__(self, store, job_id, shop):
+        self.store = store
+        self.job_id = job_id
+        self.shop = shop
+        self.counts = {"pages": 0, "embedded": 0, "written": 0}
+        self.page_ends = []  # (products up to the page, page cursor)
+        self.cursor = None
+        self.last_publish = 0.0
+        self._lock = threading.Lock()
+
+    def on_page(self, cursor, count):
+        """Shopify page fetched"""
+        with self._lock:
+            self.counts["pages"] += 1
+            self.page_ends.append((count, cursor))
+        self.publish()
+
+    def on_progress(self, stage, count, durable):
+        """Pipeline progress; checkpoints the last fully stored page"""
+        with self._lock:
+            self.counts[stage] = count
+            while durable is not None and self.page_ends:
+                if self.page_ends[0][0] > durable:
+                    break
+                self.cursor = self.page_ends.pop(0)[1]
+        self.publish()
+
+    def publish(self, force=False):
+        """Write progress to the job store and AppSetup, rate limited"""
+        now = time.monotonic()
+        if not force and now - self.last_publish < SYNC_PROGRESS_INTERVAL:
+            return
+        self.last_publish = now
+        with self._lock:
+            counts = dict(self.counts)
+            cursor = self.cursor
+        fields = dict(counts)
+        if cursor is not None:
+            fields["cursor"] = cursor
+        self.store.update(self.job_id, **fields)
+        try:
+            update_app_setup(
+                self.shop,
+                f"IN_PROGRESS ({counts['pages']} pages fetched, "
+                f"{counts['embedded']} products embedded, "
+                f"{counts['written']} products written)",
+            )
+        except Exception as e:
+            logging.error("Failed to publish sync progress for %s: %s", self.shop, e)
+
+
+class JobQueue:
+    """Worker pool running product syncs in the background"""
+
+    def __init__(self, store=None, workers=SYNC_WORKERS, per_shop=SYNC_JOBS_PER_SHOP):
+        self.store = store or JobStore()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.per_shop = per_shop
+
+    def submit(self, shop, url, headers, mode=None):
+        """Queue a sync of the shop, resuming an interrupted one; return the job id.
+
+        Raises ShopBusy when the shop already has ``per_shop`` syncs queued
+        or running, so pool threads never wait on a busy shop.
+        """
+        mode = mode or SHOPIFY_INGEST_MODE
+        if mode not in ("pages", "bulk"):
+            raise ValueError(f"Unknown ingest mode: {mode}")
+        # Bulk results cannot be resumed from a page cursor
+        cursor = self.store.resume_cursor(shop) if mode == "pages" else None
+        job_id = self.store.create(shop, cursor, limit=self.per_shop)
+        self.pool.submit(self._run, job_id, shop, url, headers, mode)
+        return job_id
+
+    def get(self, job_id):
+        """Return the job status dict, or None"""
+        return self.store.get(job_id)
+
+    def _run(self, job_id, shop, url, headers, mode):
+        with IN_FLIGHT.track_inprogress(operation="sync_job"):
+            job = self.store.get(job_id)
+            if job["cursor"]:
+                logging.info("Resuming sync of %s after %s", shop, job["cursor"])
+            self.store.update(job_id, status="running")
+            progress = SyncProgress(self.store, job_id, shop)
+            progress.cursor = job["cursor"]
+            try:
+                if mode == "bulk":
+                    products = iter_products_bulk(url, headers, progress.on_page)
+                else:
+                    products = iter_products(
+                        url, headers, cursor=job["cursor"], on_page=progress.on_page
+                    )
+                result = run_async(
+                    handle_product_sync(products, shop, progress.on_progress)
+                )
+                # handle_product_sync already set productSyncStatus to COMPLETED
+                self.store.update(
+                    job_id,
+                    status="completed",
+                    processed=result["processed"],
+                    skipped=result["skipped"],
+                    **progress.counts,
+                )
+            except Exception as e:
+                ERRORS.inc(stage="sync_job")
+                logging.error("Sync job %s for %s failed: %s", job_id, shop, e)
+                progress.publish(force=True)
+                self.store.update(job_id, status="failed", error=str(e))
+                try:
+                    update_app_setup(shop, "FAILED")
+                except Exception as setup_error:
+                    logging.error("Database operation failed: %s", setup_error)
@@ -1,126 +1,96 @@
 """main script."""
 
-import asyncio
-import json
 import logging
 import os
-import requests
+import time
 from dotenv import load_dotenv
-from fashion_clip.fashion_clip import FashionCLIP
-from flask import Flask, jsonify, request
-from openai import OpenAI
-from pydantic import BaseModel, conlist
+from flask import Flask, g, jsonify, request
 from supabase.client import create_client
-from fashion import embed_image, embed_text, recommend_outfits_with_embeddings
-from process_product import handle_product_sync, handle_product_update
+from async_runtime import run_async, run_inference
+from categorize import categorizer
+from fashion import (
+    embed_image,
+    embed_images,
+    embed_text,
+    embed_texts,
+    recommend_outfits_batch,
+)
+from jobs import JobQueue, ShopBusy
+import metrics
+from models import BASE_MODEL, model_timings, preload
+from query_cache import query_cache
+from webhook_queue import webhook_queue
 
 load_dotenv()
 # set logging level
 logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
-model = FashionCLIP("fashion-clip")
 
 supabase_key = os.environ.get("SUPABASE_ANON_KEY")
 supabase_url = os.environ.get("SUPABASE_URL")
-openai_api_key = os.environ.get("OPEN_API_KEY")
 api_version = os.environ.get("API_VERSION")
 token = os.environ.get("TOKEN")
+# Largest k accepted by /fetch-suggestions
+MAX_SUGGESTIONS = int(os.environ.get("MAX_SUGGESTIONS", 50))
 
-# Setup OpenAI Client
-openai = OpenAI(api_key=openai_api_key)
 # Set up Supabase client
 supabase_client = create_client(supabase_url, supabase_key)
+# Background product syncs started by /fetch_products_api
+sync_jobs = JobQueue()
+# Load PRELOAD_MODELS now; with gunicorn preload_app this runs in the master
+preload()
+
+
+@app.before_request
+def start_request_metrics():
+    """Track the request as in flight and start the profiler if requested"""
+    g.request_start = time.perf_counter()
+    metrics.IN_FLIGHT.inc(operation=f"http:{request.endpoint}")
+    g.profiler = metrics.start_profiler(request.headers)
+
+
+@app.after_request
+def record_response(response):
+    """Count the response and attach the profile path when profiled"""
+    if g.get("profiler") is not None:
+        g.profile_path = g.profiler.stop(request.endpoint)
+        g.profiler = None
+    if g.get("profile_path"):
+        response.headers["X-Profile-Path"] = g.profile_path
+    metrics.HTTP_REQUESTS.inc(endpoint=request.endpoint, status=response.status_code)
+    return response
+
+
+@app.before_request
+def start_webhook_drain():
+    """Drain updates queued before a restart without waiting for a webhook"""
+    webhook_queue.start()
+
+
+@app.teardown_request
+def finish_request_metrics(_error):
+    """Record the request latency, also when the handler raised"""
+    if "request_start" in g:
+        metrics.IN_FLIGHT.dec(operation=f"http:{request.endpoint}")
+        metrics.HTTP_SECONDS.observe(
+            time.perf_counter() - g.request_start, endpoint=request.endpoint
+        )
 
 
-class TagResponse(BaseModel):
-    """tag response model"""
-
-    occasionTags: conlist(str, min_length=1)  # type: ignore
-    seasonalTags: conlist(str, min_length=1)  # type: ignore
-    styleTags: conlist(str, min_length=1)  # type: ignore
-    descriptionAnalysis: conlist(str, min_length=1)  # type: ignore
-    colourAndTone: conlist(str, min_length=1)  # type: ignore
-    productCategory: str
-
-
-def fetch_products(url, headers, cursor=None):
-    """Adjust the GraphQL query to use the cursor if provided"""
-    after_clause = f', after: "{cursor}"' if cursor else ""
-    query = f"""
-    {{
-      products(first: 250{after_clause}, query: "status:active AND published_status:published AND inventory_total:>0") {{
-        edges {{
-          cursor
-          node {{
-            id
-            title
-            description
-            tags
-            totalInventory
-            onlineStoreUrl
-            priceRange {{
-              maxVariantPrice {{
-                amount
-              }}
-            }}
-            featuredImage {{
-              url
-            }}
-            productType
-            tags
-            vendor
-            variants(first: 10) {{
-              edges {{
-                node {{
-                  id
-                  price 
-                  title
-                  inventoryQuantity
-                  image {{
-                    url
-                    
-                  }}
-                  selectedOptions {{
-                    name
-                    value
-                  }}
-                }}
-              }}
-            }}
-          }}
-        }}
-        pageInfo {{
-          hasNextPage
-        }}
-      }}
-    }}
-    """
-    try:
-        response = requests.post(url, headers=headers, json={"query": query})
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        print(f"Request failed: {e}")
-        raise
-
-
-def paginate_through_all_products(url, headers):
-    """Fetch all products and return them in a list"""
-    all_products = []
-    cursor = None  # Start with no cursor
-    has_next_page = True
-
-    while has_next_page:
-        result = fetch_products(cursor=cursor, url=url, headers=headers)
+def run_request(coro):
+    """Run a handler's coroutine on the shared event loop.
 
-        products_data = result["data"]["products"]
-        edges = products_data["edges"]
-        for edge in edges:
-            all_products.append(edge["node"])
-            cursor = edge["cursor"]
-        has_next_page = products_data["pageInfo"]["hasNextPage"]
-        print(f"running count of products: {len(all_products)}")
-    return all_products
+    The request thread only waits for the loop, so a profiled request is
+    profiled inside the coroutine instead.
+    """
+    if g.get("profiler") is None:
+        return run_async(coro)
+    g.profiler.cancel()
+    g.profiler = None
+    result, g.profile_path = run_async(
+        metrics.profile_coroutine(coro, request.endpoint)
+    )
+    return result
 
 
 def process_variant_data(product_data):
@@ -173,42 +143,7 @@ def process_variant_data(product_data):
 
 def generate_tags(product_content):
     """Generate tags for a product"""
-    TAGS_PROMPT = f"""
-    Your job is to generate a json object of tags and information regarding a product to be used later on for matching outfits of different products together.
-    The object should contain the following fields: occasionTags (string array), seasonalTags: (string array), styleTags (string array), descriptionAnalysis (string array), colourAndTone (string array), productCategory (string).
-    Here is a breakdown of the following fields:
-    - occasionTags: A string array of tags that denote the occasion (e.g., “office,” “casual,” “date night”).
-    - seasonalTags: A string array of tags related to the season (e.g., “summer,” “winter”).
-    - styleTags: A string array of tags that indicate the style (e.g., “boho,” “classic,” “modern”).
-    - descriptionAnalysis: A string array of keywords from item descriptions to understand additional attributes like material, fit, and special features (e.g., “stretchy,” “lightweight”). Do not include information regarding clothing material percentages or cleaning instructions here.
-    - colourAndTone: A string array of tags regarding the products color and tone. (e.g., "Neutral", "Neon", "Purple", Beige", "Red", etc...). Make sure you add at least one tag regarding tone in addition to the colour tags.
-    - productCategory: A string of the product category (e.g., "Dress", "Shorts", "Pants", "Bottom", "Accessory", "Top").
-    Here is the product information: {product_content}
-    
-    """
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": TAGS_PROMPT},
-        ],
-    )
-    product_id = product_content["id"]
-    try:
-        print(response.choices[0].message.content)
-        tags = json.loads(response.choices[0].message.content)
-        print(tags)
-        validated_tags = TagResponse(**tags)
-        # print validated tags
-
-        print(f"Validated tags: {validated_tags} for product {product_id}")
-
-        return tags
-
-    except Exception as e:
-        print(f"Error generating or validating tags {product_id}: {e}")
-
-    return {}
+    return run_request(categorizer.tags([product_content]))[0]
 
 
 # Decorator to check if the token is provided and valid
@@ -232,9 +167,12 @@ def fetch_products_api():
     """Fetch products from Shopify"""   
     shop_url = request.args.get("shop_url")
     access_token = request.args.get("access_token")
+    mode = request.args.get("mode")  # optional, "pages" or "bulk"
 
     if not shop_url or not access_token:
         return jsonify({"error": "Missing shop_url or access_token"}), 400
+    if mode not in (None, "pages", "bulk"):
+        return jsonify({"error": "mode must be 'pages' or 'bulk'"}), 400
 
     url = f"https://{shop_url}/admin/api/{api_version}/graphql.json"
     headers = {
@@ -243,8 +181,10 @@ def fetch_products_api():
     }
     try:
         print(f"using url {url}")
-        products = paginate_through_all_products(url=url, headers=headers)
-        return asyncio.run(handle_product_sync(products, shop_url))
+        job_id = sync_jobs.submit(shop_url, url, headers, mode)
+        return jsonify({"status": "queued", "job_id": job_id}), 202
+    except ShopBusy as e:
+        return jsonify({"error": str(e), "job_id": e.job_id}), 409
     except Exception as e:
         logging.error("Error processing products: %s", e)
         return (
@@ -253,6 +193,16 @@ def fetch_products_api():
         )
 
 
+@app.route("/sync_jobs/<job_id>", endpoint="sync-job-status", methods=["GET"])
+@require_token
+def sync_job_status(job_id):
+    """Return the status and progress of a product sync job"""
+    job = sync_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job), 200
+
+
 @app.route("/update_products_api", endpoint="update-products", methods=["POST"])
 @require_token
 def update_products():
@@ -261,10 +211,13 @@ def update_products():
     shop = data.get("shop")
     product = data.get("product")
 
-    if not shop or not product:
+    if not shop or not product or not product.get("id"):
         return jsonify({"error": "Missing shop or product"}), 400
 
-    return asyncio.run(handle_product_update(product, shop))
+    # Acknowledged once queued; bursts of webhooks for the same product are
+    # coalesced and processed in batches by the queue's drain thread
+    webhook_queue.enqueue(shop, product)
+    return jsonify({"status": "queued"}), 202
 
 
 @app.route("/fetch-suggestions", endpoint="fetch-suggestions", methods=["POST"])
@@ -277,30 +230,35 @@ def fetch_suggestions():
         "inputs"
     )  # format: [{"item_type": "Dress", "input": "Fall Breezy Dress"}]
 
-    input_texts = [item["input"] for item in inputs]
-    item_types = [item["item_type"] for item in inputs]
-    encodings = model.encode_text(input_texts, len(input_texts))
-
-    inputs_two = []
-    for i in range(len(item_types)):
-        inputs_two.append({"embedding": encodings[i], "item_type": item_types[i]})
+    k = data.get("k")  # optional, returns a ranked list of k results per input
+    dedupe = bool(data.get("dedupe", False))  # at most one variant per product
+    # bool is a subclass of int, so true would otherwise pass as k=1
+    if k is not None and (
+        not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_SUGGESTIONS
+    ):
+        return (
+            jsonify({"error": f"k must be an integer from 1 to {MAX_SUGGESTIONS}"}),
+            400,
+        )
 
-    recommendations = asyncio.run(get_reccs(shop_url, inputs_two))
+    # Runs on the worker's shared event loop, so concurrent requests share
+    # its pooled Supabase connections
+    recommendations = run_request(get_reccs(shop_url, inputs, k, dedupe))
 
     return jsonify(recommendations), 200
 
 
-async def get_reccs(shop_url, inputs):
+async def get_reccs(shop_url, inputs, k=None, dedupe=False):
     """Fetch recommendations based on embeddings"""
-    tasks = [
-        recommend_outfits_with_embeddings(
-            input["embedding"], shop_url, input["item_type"]
-        )
-        for input in inputs
-    ]
-    # Gather results asynchronously
-    results = await asyncio.gather(*tasks)
-    return results
+    input_texts = [item["input"] for item in inputs]
+    item_types = [item["item_type"] for item in inputs]
+    # Repeated prompts are served from the cache; only misses are encoded
+    encodings = await run_inference(query_cache.encode, BASE_MODEL, input_texts)
+
+    # A single catalog query and matrix product covers every input
+    return await recommend_outfits_batch(
+        list(encodings), shop_url, item_types, k=k, dedupe=dedupe
+    )
 
 
 @app.route("/embed-text", endpoint="embed-text", methods=["POST"])
@@ -308,6 +266,9 @@ def embed_text_req():
     """Embed text and return the embedding"""
     body = request.get_json()
     description = body.get("description")
+    # Checked before batching, so a bad input cannot fail concurrent requests
+    if not isinstance(description, str) or not description:
+        return jsonify({"error": "description must be a non-empty string"}), 400
     return jsonify(embed_text(description)), 200
 
 
@@ -316,10 +277,67 @@ def embed_image_req():
     """Embed image and return the embedding"""
     body = request.get_json()
     image = body.get("imageUrl")
-    print(image)
+    if not isinstance(image, str) or not image:
+        return jsonify({"error": "imageUrl must be a non-empty string"}), 400
     return jsonify(embed_image(image)), 200
 
 
+@app.route("/embed-text/batch", endpoint="embed-text-batch", methods=["POST"])
+def embed_text_batch_req():
+    """Embed a list of texts, return per-item embeddings or errors in order"""
+    body = request.get_json()
+    descriptions = body.get("descriptions")
+    if not isinstance(descriptions, list):
+        return jsonify({"error": "descriptions must be a list"}), 400
+
+    valid = [
+        i
+        for i, description in enumerate(descriptions)
+        if isinstance(description, str) and description
+    ]
+    embeddings = embed_texts([descriptions[i] for i in valid])
+    error = {"error": "description must be a non-empty string"}
+    results = [error] * len(descriptions)
+    for i, embedding in zip(valid, embeddings):
+        results[i] = {"embedding": embedding}
+    return jsonify({"results": results}), 200
+
+
+@app.route("/embed-image/batch", endpoint="embed-image-batch", methods=["POST"])
+def embed_image_batch_req():
+    """Embed a list of image urls, return per-item embeddings or errors in order"""
+    body = request.get_json()
+    image_urls = body.get("imageUrls")
+    if not isinstance(image_urls, list):
+        return jsonify({"error": "imageUrls must be a list"}), 400
+
+    valid = [url for url in image_urls if isinstance(url, str) and url]
+    errors = {}
+    # Downloads run concurrently and images are encoded in batches
+    embeddings = embed_images(valid, errors=errors)
+    results = []
+    for url in image_urls:
+        if url in embeddings:
+            results.append({"embedding": embeddings[url]})
+        elif isinstance(url, str) and url:
+            results.append({"error": errors.get(url, "Failed to embed image")})
+        else:
+            results.append({"error": "imageUrl must be a non-empty string"})
+    return jsonify({"results": results}), 200
+
+
+@app.route("/models", endpoint="models", methods=["GET"])
+def models_req():
+    """Return model cold start and first inference timings"""
+    return jsonify(model_timings()), 200
+
+
+@app.route("/metrics", endpoint="metrics", methods=["GET"])
+def metrics_req():
+    """Prometheus metrics of this worker process"""
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
 @app.route("/")
 def hello():
     """test endpoint"""
@@ -0,0 +1,325 @@
+"""Prometheus metrics and per-request profiling.
+
+Metrics are kept per process and rendered in the Prometheus text format by
+``render()``; with several gunicorn workers each scrape reports the worker
+that answered it.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Profile requests sent with an "X-Profile: 1" header
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+# Fraction of all requests profiled, e.g. 0.001
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+# Directory profiles are written to
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+_registry = []
+
+
+def format_labels(names, values):
+    """Prometheus label set, e.g. {stage="llm"}"""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    """Prometheus sample value"""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """A named metric family with fixed label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Yield (name, label names, label values, value)"""
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, self.labels, key, value
+
+    def render(self):
+        """HELP, TYPE and sample lines"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(
+                f"{name}{format_labels(label_names, label_values)} {format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount``"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @contextmanager
+    def count_exceptions(self, **labels):
+        """Count exceptions raised in the block, re-raising them"""
+        try:
+            yield
+        except Exception:
+            self.inc(**labels)
+            raise
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount``"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Subtract ``amount``"""
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """Set the value"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """Count the block as in progress while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class CallbackGauge(Metric):
+    """Gauge read at scrape time from ``func() -> {label values: value}``"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels, func):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def samples(self):
+        for key, value in sorted(self.func().items()):
+            yield self.name, self.labels, key, value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        """Record a value"""
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            }
+        bucket_labels = self.labels + ("le",)
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", bucket_labels, key + (le,), cumulative
+            yield f"{self.name}_sum", self.labels, key, total
+            yield f"{self.name}_count", self.labels, key, count
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "product_service_stage_seconds",
+    "Duration of hot-path stages (shopify_page, shopify_bulk, shopify_throttle_wait, "
+    "llm, image_download, encode_text, encode_image, db_write, catalog_fetch, "
+    "catalog_details, scoring, webhook_batch).",
+    ["stage"],
+)
+ERRORS = Counter("product_service_errors_total", "Errors by stage.", ["stage"])
+CACHE_LOOKUPS = Counter(
+    "product_service_cache_lookups_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ["cache", "result"],
+)
+IN_FLIGHT = Gauge(
+    "product_service_in_flight", "Operations currently in progress.", ["operation"]
+)
+HTTP_SECONDS = Histogram(
+    "product_service_http_request_seconds", "HTTP request latency.", ["endpoint"]
+)
+HTTP_REQUESTS = Counter(
+    "product_service_http_requests_total",
+    "HTTP responses by endpoint and status.",
+    ["endpoint", "status"],
+)
+
+
+def count_cache(cache, hits, misses):
+    """Record cache hits and misses"""
+    if hits:
+        CACHE_LOOKUPS.inc(hits, cache=cache, result="hit")
+    if misses:
+        CACHE_LOOKUPS.inc(misses, cache=cache, result="miss")
+
+
+class RequestProfiler:
+    """Profile of one request: pyinstrument (sampling) if installed, else cProfile"""
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+
+            self.profiler = Profiler()
+            self.profiler.start()
+        except ImportError:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def cancel(self):
+        """Stop profiling without writing a report"""
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+
+    def stop(self, name):
+        """Stop profiling and write the report, return its path"""
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+            buffer = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=buffer)
+            stats.sort_stats("cumulative").print_stats(60)
+            report = buffer.getvalue()
+        else:
+            self.profiler.stop()
+            report = self.profiler.output_text()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(
+            PROFILE_DIR, f"{name}-{int(time.time() * 1000)}-{os.getpid()}.txt"
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(report)
+        return path
+
+
+def start_profiler(headers):
+    """A started RequestProfiler if this request should be profiled, else None"""
+    requested = PROFILE_REQUESTS and headers.get("X-Profile") == "1"
+    sampled = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not (requested or sampled):
+        return None
+    try:
+        return RequestProfiler()
+    except (RuntimeError, ValueError) as e:
+        # Only one profiler can be active per thread
+        logging.warning("Could not start request profiler: %s", e)
+        return None
+
+
+async def profile_coroutine(coro, name):
+    """Await ``coro`` under a profiler started on the event loop.
+
+    Returns the result and the report path. pyinstrument follows the task
+    across awaits (executor work shows as await time); the cProfile fallback
+    sees everything the loop thread runs meanwhile, other requests included.
+    """
+    try:
+        profiler = RequestProfiler()
+    except (RuntimeError, ValueError) as e:
+        logging.warning("Could not start request profiler: %s", e)
+        return await coro, None
+    try:
+        result = await coro
+    except BaseException:
+        profiler.cancel()
+        raise
+    return result, profiler.stop(name)
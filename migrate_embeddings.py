@@ -0,0 +1,63 @@
+"""Backfill compact embedding columns for existing rows.
+
+Usage: python migrate_embeddings.py [--format float16] [--page-size 500]
+
+Run it with EMBEDDING_STORAGE set to the same format, so rows written in the
+meantime get compact columns too, then set READ_COMPACT_EMBEDDINGS=1.
+"""
+
+import argparse
+import logging
+
+from db import supabase_client
+from embedding_codec import encode
+
+TABLES = {
+    "products": ("product_id", "description_embedding"),
+    "variants": ("variant_id", "image_embedding"),
+}
+
+
+def migrate_table(table, key, column, fmt, page_size):
+    """Encode ``column`` into ``column_q`` for rows that do not have it yet"""
+    migrated = 0
+    last_key = ""
+    while True:
+        rows = (
+            supabase_client.table(table)
+            .select(f"{key}, {column}")
+            .is_(f"{column}_q", "null")
+            .gt(key, last_key)
+            .order(key)
+            .limit(page_size)
+            .execute()
+            .data
+        )
+        if not rows:
+            return migrated
+        last_key = rows[-1][key]
+        for row in rows:
+            if not row[column]:
+                continue
+            supabase_client.table(table).update(
+                {f"{column}_q": encode(row[column], fmt)}
+            ).eq(key, row[key]).execute()
+            migrated += 1
+        logging.info("%s: %d rows migrated", table, migrated)
+
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=["float16", "int8"], default="float16")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for table, (key, column) in TABLES.items():
+        migrated = migrate_table(table, key, column, args.format, args.page_size)
+        print(f"{table}: {migrated} rows migrated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+-- Content fingerprints used by incremental product sync to skip unchanged
+-- products and reuse embeddings of unchanged variant images.
+alter table products add column if not exists fingerprint text;
+alter table variants add column if not exists image_fingerprint text;
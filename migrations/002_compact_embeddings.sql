@@ -0,0 +1,4 @@
+-- Compact base64 float16/int8 copies of the embeddings (see embedding_codec.py).
+-- Backfill existing rows with: python migrate_embeddings.py --format float16
+alter table products add column if not exists description_embedding_q text;
+alter table variants add column if not exists image_embedding_q text;
@@ -0,0 +1,131 @@
+"""shared FashionCLIP model registry."""
+
+import logging
+import os
+import threading
+import time
+
+from metrics import IN_FLIGHT, STAGE_SECONDS
+
+# Model encoding shopper queries on /fetch-suggestions
+BASE_MODEL = os.environ.get("BASE_MODEL", "fashion-clip")
+# Model embedding catalog products and the /embed-* endpoints
+FINETUNED_MODEL = os.environ.get(
+    "FINETUNED_MODEL", "justin-shopcapsule/screenshot-fashion-clip-finetuned"
+)
+# Inference backend: "torch" (float32) or "int8" (dynamically quantized
+# Linear layers, CPU only)
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "torch")
+# Comma-separated model names loaded by preload(), e.g. in the gunicorn master
+PRELOAD_MODELS = [
+    name.strip() for name in os.environ.get("PRELOAD_MODELS", "").split(",") if name
+]
+
+_models = {}
+_timings = {}
+_lock = threading.Lock()
+
+
+class TimedModel:
+    """Wraps a model to record inference metrics and its first inference time"""
+
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self._first_call = True
+
+    def _timed(self, method, stage, *args, **kwargs):
+        with IN_FLIGHT.track_inprogress(operation="inference"):
+            with STAGE_SECONDS.time(stage=stage):
+                if not self._first_call:
+                    return getattr(self.model, method)(*args, **kwargs)
+                start = time.monotonic()
+                result = getattr(self.model, method)(*args, **kwargs)
+        if self._first_call:
+            self._first_call = False
+            elapsed = time.monotonic() - start
+            _timings[self.name]["first_inference_seconds"] = elapsed
+            logging.info("First inference of %s took %.2fs", self.name, elapsed)
+        return result
+
+    def encode_text(self, *args, **kwargs):
+        """FashionCLIP.encode_text"""
+        return self._timed("encode_text", "encode_text", *args, **kwargs)
+
+    def encode_images(self, *args, **kwargs):
+        """FashionCLIP.encode_images"""
+        return self._timed("encode_images", "encode_image", *args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.model, attr)
+
+
+def quantize(model):
+    """Replace the Linear layers of both CLIP towers with dynamic int8 ones"""
+    import torch
+
+    model.model = torch.quantization.quantize_dynamic(
+        model.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return model
+
+
+def load_model(name, backend):
+    """Load a FashionCLIP model for the given backend"""
+    # Imported here so processes that never load a model skip torch
+    from fashion_clip.fashion_clip import FashionCLIP
+
+    model = FashionCLIP(name)
+    if backend == "int8":
+        return quantize(model)
+    if backend != "torch":
+        raise ValueError(f"Unknown model backend: {backend}")
+    return model
+
+
+def model_key(name, backend):
+    """Registry key of a model and backend"""
+    return f"{name}[{backend}]" if backend != "torch" else name
+
+
+def register_model(name, model, backend=None):
+    """Use ``model`` for ``name`` instead of loading it, e.g. a benchmark stub.
+
+    The model needs ``encode_text(texts, batch_size)`` and
+    ``encode_images(images, batch_size)`` returning numpy arrays.
+    """
+    key = model_key(name, backend or MODEL_BACKEND)
+    with _lock:
+        _timings[key] = {"load_seconds": 0.0, "first_inference_seconds": None}
+        _models[key] = TimedModel(key, model)
+
+
+def get_model(name, backend=None):
+    """Return the named model, loading it once per process on first use"""
+    backend = backend or MODEL_BACKEND
+    key = model_key(name, backend)
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _lock:
+        if key not in _models:
+            start = time.monotonic()
+            loaded = load_model(name, backend)
+            elapsed = time.monotonic() - start
+            _timings[key] = {"load_seconds": elapsed, "first_inference_seconds": None}
+            _models[key] = TimedModel(key, loaded)
+            logging.info(
+                "Loaded model %s in %.2fs (pid %d)", key, elapsed, os.getpid()
+            )
+        return _models[key]
+
+
+def preload(names=None):
+    """Load models up front; in the gunicorn master, workers share them on fork"""
+    for name in names if names is not None else PRELOAD_MODELS:
+        get_model(name)
+
+
+def model_timings():
+    """Cold start and first inference seconds of every loaded model"""
+    return {name: dict(timing) for name, timing in _timings.items()}
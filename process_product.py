@@ -1,109 +1,318 @@
 """process product script."""
 
+import asyncio
+import hashlib
+import itertools
 import json
+import logging
 import os
+import time
 from supabase import create_client, Client
-from openai import OpenAI
-from db import update_app_setup, create_product, product_exists, update_product
-from fashion import embed_text, embed_image
+from async_runtime import run_blocking_io, run_inference
+from categorize import categorizer
+from db import (
+    BulkWriter,
+    fetch_fingerprints,
+    fetch_variant_images,
+    update_app_setup,
+)
+from fashion import embed_texts, embed_images, embedding_index
+from metrics import ERRORS
 
 supabase: Client = create_client(
     os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_ANON_KEY")
 )
 
-# Initialize OpenAI client
-openai = OpenAI(api_key=os.getenv("OPEN_API_KEY"))
-
-
-def fetch_product_category(product):
-    """Fetch product category using OpenAI GPT."""
-    try:
-        response = openai.chat.completions.create(
-            response_format={"type": "json_object"},
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Categorize a product given the title and description.\n"
-                        "The response should be a JSON object with a single field: productCategory (string).\n"
-                        f"Product info: {product['title']} - {product['description']}"
-                    ),
-                }
-            ],
+# Products processed together per sync step (image downloads, embeddings)
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", 50))
+# Chunks buffered between consecutive pipeline stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))
+
+
+def variant_image_url(variant, product):
+    """Return the variant image url, falling back to the product image, or ""."""
+    image = variant["node"].get("image") or product.get("featuredImage") or {}
+    return image.get("url") or ""
+
+
+def image_fingerprint(image_url):
+    """Fingerprint of a variant image, stored with its embedding."""
+    return hashlib.sha256(image_url.encode("utf-8")).hexdigest()
+
+
+def product_fingerprint(product):
+    """Fingerprint of everything the categories and embeddings depend on."""
+    content = {
+        "title": product.get("title"),
+        "description": product.get("description"),
+        "featuredImage": (product.get("featuredImage") or {}).get("url"),
+        "updatedAt": product.get("updatedAt"),
+        "variants": [
+            [variant["node"]["id"], variant_image_url(variant, product)]
+            for variant in product["variants"]["edges"]
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def reuse_image_embeddings(products, image_embedding_cache):
+    """Seed the cache with stored embeddings of variant images that did not change."""
+    stored = fetch_variant_images([product["id"] for product in products])
+    for product in products:
+        for variant in product["variants"]["edges"]:
+            fingerprint, embedding = stored.get(variant["node"]["id"], (None, None))
+            image_url = variant_image_url(variant, product)
+            if embedding and fingerprint == image_fingerprint(image_url):
+                image_embedding_cache.setdefault(image_url, embedding)
+
+
+def embed_product_images(products, image_embedding_cache):
+    """Embed every variant image of the products not already in the cache."""
+    image_urls = [
+        variant_image_url(variant, product)
+        for product in products
+        for variant in product["variants"]["edges"]
+    ]
+    missing = [url for url in image_urls if url and url not in image_embedding_cache]
+    if missing:
+        start = time.time()
+        image_embedding_cache.update(embed_images(missing))
+        logging.debug(
+            "embedded %d images in %.2fs", len(set(missing)), time.time() - start
         )
-        response_dict = response.model_dump()
-        return json.loads(
-            response_dict["choices"][0]["message"]["content"] or "{}"
-        ).get("productCategory")
-    except Exception as e:
-        print(f"Error fetching product category for {product['title']}: {e}")
-        return None
 
 
 def process_variant(variant, product, image_embedding_cache):
-    """Process a product variant, including embedding images."""
-    image_url = (
-        variant["node"]["image"]["url"]
-        if variant["node"].get("image") is not None
-        else product["featuredImage"]["url"]
-    )
+    """Build a variant row from the embeddings computed by embed_product_images."""
+    image_url = variant_image_url(variant, product)
     image_embedding = image_embedding_cache.get(image_url)
-    print("product Image URL:", image_url)
     if not image_embedding:
-        try:
-            image_embedding = embed_image(image_url)
-            image_embedding_cache[image_url] = image_embedding
-        except Exception as e:
-            print(f"Error embedding image for {image_url}: {e}")
-            image_embedding = []
+        if image_url:
+            ERRORS.inc(stage="image_embed")
+            logging.warning("Error embedding image for %s", image_url)
+        image_embedding = []
 
     return {
         "product_id": product["id"],
         "variant_id": variant["node"]["id"],
         "content": variant["node"],
         "image_embedding": image_embedding,
+        "image_fingerprint": image_fingerprint(image_url) if image_embedding else None,
     }
 
 
-def handle_product_sync(products, shop):
-    """Sync products from Shopify to Supabase and compute embeddings."""
-    image_embedding_cache = {}
-    for product in products:
-        item_type = fetch_product_category(product)
-        print(item_type)
-        variant_data = []
-        for variant in product["variants"]["edges"]:
-            variant_data.append(
-                process_variant(variant, product, image_embedding_cache)
-            )
+def embed_descriptions(products):
+    """Embed the title and description of every product in batched calls."""
+    descriptions = [
+        f"{product['title']} - {product['description']}" for product in products
+    ]
+    start = time.time()
+    text_embeddings = embed_texts(descriptions)
+    elapsed = time.time() - start
+    if products:
+        logging.debug(
+            "embedded %d descriptions in %.2fs (%.1f products/s)",
+            len(products),
+            elapsed,
+            len(products) / max(elapsed, 1e-9),
+        )
+    return text_embeddings
+
 
-        descriptions = f"{product['title']} - {product['description']}"
-        text_embeddings = embed_text(descriptions)
-        if not product_exists(product["id"]):
-            create_product(shop, product, text_embeddings, item_type, variant_data)
-        else:
-            update_product(shop, product, text_embeddings, item_type, variant_data)
+async def iter_chunks(products):
+    """Group a list, generator or async iterator of products into chunks.
+
+    Blocking generators (e.g. paginated Shopify fetches) are advanced on a
+    worker thread so fetching overlaps with the rest of the pipeline.
+    """
+    if hasattr(products, "__aiter__"):
+        chunk = []
+        async for product in products:
+            chunk.append(product)
+            if len(chunk) >= SYNC_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    iterator = iter(products)
+    while True:
+        chunk = await run_blocking_io(
+            lambda: list(itertools.islice(iterator, SYNC_CHUNK_SIZE))
+        )
+        if not chunk:
+            return
+        yield chunk
+
+
+async def categorise_stage(products):
+    """Drop unchanged products from a chunk and categorise the rest."""
+    ids = [product["id"] for product in products]
+    stored = await run_blocking_io(fetch_fingerprints, ids)
+    fingerprints = {product["id"]: product_fingerprint(product) for product in products}
+    changed = [
+        product
+        for product in products
+        if stored.get(product["id"]) != fingerprints[product["id"]]
+    ]
+    batch = {
+        "products": changed,
+        "skipped": len(products) - len(changed),
+        "fingerprints": fingerprints,
+        "image_embeddings": {},
+        "item_types": [],
+    }
+    if changed:
+        await run_blocking_io(
+            reuse_image_embeddings,
+            [product for product in changed if product["id"] in stored],
+            batch["image_embeddings"],
+        )
+        batch["item_types"] = await categorizer.categories(changed)
+    return batch
 
-    update_app_setup(shop, "COMPLETED")
-    return {"status": "success"}
 
+def embed_stage(batch):
+    """Embed the variant images and descriptions of a categorised chunk."""
+    embed_product_images(batch["products"], batch["image_embeddings"])
+    batch["text_embeddings"] = embed_descriptions(batch["products"])
+    return batch
 
-def handle_product_update(product, shop):
+
+def write_stage(batch, shop, writer):
+    """Buffer the rows of an embedded chunk for the bulk writer.
+
+    Products whose categorisation failed are not written, so a stored
+    category is never replaced by NULL; their ids are listed in
+    ``batch["failed"]``.
+    """
+    batch["failed"] = []
+    for product, product_embedding, item_type in zip(
+        batch["products"], batch["text_embeddings"], batch["item_types"]
+    ):
+        if item_type is None:
+            logging.warning("Not writing %s: categorisation failed", product["id"])
+            batch["failed"].append(product["id"])
+            continue
+        variant_data = [
+            process_variant(variant, product, batch["image_embeddings"])
+            for variant in product["variants"]["edges"]
+        ]
+        # Only fingerprint complete results, so failures are retried next sync
+        complete = all(variant["image_embedding"] for variant in variant_data)
+        writer.add(
+            shop,
+            product,
+            product_embedding,
+            item_type,
+            variant_data,
+            fingerprint=batch["fingerprints"][product["id"]] if complete else None,
+        )
+    return batch
+
+
+async def run_sync_pipeline(products, shop, progress=None):
+    """Stream products through fetch -> categorise -> embed -> write.
+
+    Stages run concurrently on chunks of SYNC_CHUNK_SIZE products and are
+    connected by queues of PIPELINE_QUEUE_SIZE chunks, so memory stays
+    bounded whatever the catalog size. ``progress(stage, count, durable)``
+    is called with cumulative "embedded" and "written" product counts on a
+    worker thread, since it may block (database writes);
+    ``durable`` is how many input products are fully stored (or skipped).
+    Returns the processed and skipped counts and the ids of products that
+    were not written because their categorisation failed.
+    """
+    fetched, categorised, embedded = (
+        asyncio.Queue(PIPELINE_QUEUE_SIZE) for _ in range(3)
+    )
+    counts = {"processed": 0, "skipped": 0, "embedded": 0}
+    failed = []
+    progress = progress or (lambda stage, count, durable: None)
+
+    async def fetch():
+        async for chunk in iter_chunks(products):
+            await fetched.put(chunk)
+        await fetched.put(None)
+
+    async def categorise():
+        while (chunk := await fetched.get()) is not None:
+            await categorised.put(await categorise_stage(chunk))
+        await categorised.put(None)
+
+    async def embed():
+        while (batch := await categorised.get()) is not None:
+            batch = await run_inference(embed_stage, batch)
+            counts["embedded"] += len(batch["products"])
+            await run_blocking_io(progress, "embedded", counts["embedded"], None)
+            await embedded.put(batch)
+        await embedded.put(None)
+
+    async def write(writer):
+        while (batch := await embedded.get()) is not None:
+            await run_blocking_io(write_stage, batch, shop, writer)
+            counts["processed"] += len(batch["products"]) - len(batch["failed"])
+            counts["skipped"] += batch["skipped"]
+            failed.extend(batch["failed"])
+            writer.mark(counts["processed"] + counts["skipped"] + len(failed))
+            await run_blocking_io(progress, "written", writer.written, writer.durable)
+
+    with BulkWriter() as writer:
+        tasks = [
+            asyncio.create_task(stage)
+            for stage in (fetch(), categorise(), embed(), write(writer))
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        await run_blocking_io(writer.flush)
+        await run_blocking_io(progress, "written", writer.written, writer.durable)
+    return counts["processed"], counts["skipped"], failed
+
+
+async def handle_product_sync(products, shop, progress=None):
     """Sync products from Shopify to Supabase and compute embeddings."""
-    image_embedding_cache = {}
-
-    item_type = fetch_product_category(product)
-    print(item_type)
-    variant_data = []
-    for variant in product["variants"]["edges"]:
-        variant_data.append(process_variant(variant, product, image_embedding_cache))
-
-    descriptions = f"{product['title']} - {product['description']}"
-    text_embeddings = embed_text(descriptions)
-
-    if product_exists(product["id"]):
-        update_product(shop, product, text_embeddings, item_type, variant_data)
-    else:
-        create_product(shop, product, text_embeddings, item_type, variant_data)
-    return {"status": "success"}
+    processed, skipped, failed = await run_sync_pipeline(products, shop, progress)
+
+    logging.info(
+        "Sync for %s: %d products processed, %d unchanged, %d failed",
+        shop,
+        processed,
+        skipped,
+        len(failed),
+    )
+    embedding_index.invalidate(shop)
+    await run_blocking_io(update_app_setup, shop, "COMPLETED")
+    return {
+        "status": "success",
+        "processed": processed,
+        "skipped": skipped,
+        "failed": len(failed),
+    }
+
+
+async def handle_product_update(product, shop):
+    """Sync products from Shopify to Supabase and compute embeddings."""
+    return await handle_product_updates([product], shop)
+
+
+async def handle_product_updates(products, shop):
+    """Sync a batch of updated products of a shop, e.g. coalesced webhooks.
+
+    ``failed`` lists the ids of products that were not written.
+    """
+    processed, skipped, failed = await run_sync_pipeline(products, shop)
+    if processed:
+        embedding_index.invalidate(shop)
+    return {
+        "status": "success",
+        "processed": processed,
+        "skipped": skipped,
+        "failed": failed,
+    }
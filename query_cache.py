@@ -0,0 +1,67 @@
+"""query text embedding cache."""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import count_cache
+from models import get_model
+
+# Maximum (model, text) embeddings kept in memory per process
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 10000))
+
+
+def normalize_text(text):
+    """Cache key form of a query; CLIP's tokenizer lowercases anyway"""
+    return " ".join(str(text).split()).lower()
+
+
+class QueryEmbeddingCache:
+    """Bounded, thread-safe LRU cache of text embeddings keyed by (model, text)"""
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, model_name, texts):
+        """Return a (len(texts), dim) matrix, only encoding uncached texts"""
+        keys = [(model_name, normalize_text(text)) for text in texts]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    vectors[key] = self._entries[key]
+            hits = sum(key in vectors for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        count_cache("query", hits, len(keys) - hits)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing:
+            encoded = get_model(model_name).encode_text(
+                [text for _, text in missing], len(missing)
+            )
+            with self._lock:
+                for key, vector in zip(missing, np.atleast_2d(encoded)):
+                    vector = np.array(vector, dtype=np.float32)
+                    vector.flags.writeable = False
+                    vectors[key] = vector
+                    self._entries[key] = vector
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return np.vstack([vectors[key] for key in keys])
+
+    def stats(self):
+        """Hit and miss counters and current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+query_cache = QueryEmbeddingCache()
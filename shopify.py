@@ -0,0 +1,433 @@
+"""shopify product fetch script."""
+
+import json
+import logging
+import os
+import time
+
+import requests
+
+from metrics import ERRORS, STAGE_SECONDS
+
+# Keep-alive connections to the Admin API, reused across pages and syncs
+session = requests.Session()
+
+# Products and variants per product requested by the first page; later
+# pages are sized from the query cost Shopify reports
+SHOPIFY_PAGE_SIZE = int(os.environ.get("SHOPIFY_PAGE_SIZE", 25))
+SHOPIFY_VARIANTS = int(os.environ.get("SHOPIFY_VARIANTS", 10))
+# Variants per product are doubled up to this while products come back truncated
+SHOPIFY_MAX_VARIANTS = int(os.environ.get("SHOPIFY_MAX_VARIANTS", 100))
+# Retries of throttled or rate limited requests
+SHOPIFY_MAX_RETRIES = int(os.environ.get("SHOPIFY_MAX_RETRIES", 8))
+# Shopify's limits: single query cost and connection page size
+MAX_QUERY_COST = 1000
+MAX_PAGE_SIZE = 250
+
+# Seconds between bulk operation status polls, and before giving up
+BULK_POLL_INTERVAL = float(os.environ.get("SHOPIFY_BULK_POLL_INTERVAL", 2))
+BULK_TIMEOUT = float(os.environ.get("SHOPIFY_BULK_TIMEOUT", 3600))
+# Products between on_page progress callbacks in bulk mode
+BULK_PROGRESS_EVERY = 250
+
+# Same fields as fetch_products, without pagination or the variant cap
+BULK_PRODUCTS_QUERY = """
+{
+  products(query: "status:active AND published_status:published AND inventory_total:>0") {
+    edges {
+      node {
+        id
+        title
+        description
+        tags
+        totalInventory
+        onlineStoreUrl
+        priceRange {
+          maxVariantPrice {
+            amount
+          }
+        }
+        featuredImage {
+          url
+        }
+        productType
+        vendor
+        updatedAt
+        variants {
+          edges {
+            node {
+              id
+              price
+              title
+              inventoryQuantity
+              image {
+                url
+              }
+              selectedOptions {
+                name
+                value
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class QueryCostExceeded(RuntimeError):
+    """The query's requested cost is above what Shopify accepts"""
+
+    def __init__(self, requested):
+        super().__init__(f"Query cost {requested} exceeds {MAX_QUERY_COST}")
+        self.requested = requested
+
+
+class CostThrottle:
+    """Client-side model of Shopify's GraphQL cost bucket.
+
+    Every response reports the bucket size, the points currently available
+    and the restore rate; requests wait until their expected cost has been
+    restored, so a sync runs at the restore rate instead of hitting
+    THROTTLED errors.
+    """
+
+    def __init__(self):
+        self.maximum = None
+        self.available = None
+        self.restore_rate = None
+        self.updated_at = None
+
+    def update(self, result):
+        """Read ``extensions.cost.throttleStatus`` of a response"""
+        cost = (result.get("extensions") or {}).get("cost") or {}
+        status = cost.get("throttleStatus")
+        if status:
+            self.maximum = float(status["maximumAvailable"])
+            self.available = float(status["currentlyAvailable"])
+            self.restore_rate = float(status["restoreRate"])
+            self.updated_at = time.monotonic()
+
+    def delay(self, cost):
+        """Seconds until ``cost`` points are available, 0 if unknown"""
+        if self.available is None or not self.restore_rate:
+            return 0.0
+        elapsed = time.monotonic() - self.updated_at
+        available = min(self.maximum, self.available + elapsed * self.restore_rate)
+        cost = min(cost, self.maximum)
+        return max(0.0, (cost - available) / self.restore_rate)
+
+    def wait(self, cost):
+        """Sleep until ``cost`` points are available"""
+        delay = self.delay(cost)
+        if delay > 0:
+            with STAGE_SECONDS.time(stage="shopify_throttle_wait"):
+                time.sleep(delay)
+
+
+def error_codes(result):
+    """``extensions.code`` of every GraphQL error in a response"""
+    return [
+        (error.get("extensions") or {}).get("code")
+        for error in result.get("errors") or []
+    ]
+
+
+def requested_cost(result):
+    """Requested query cost reported with a response, or None"""
+    cost = (result.get("extensions") or {}).get("cost") or {}
+    return cost.get("requestedQueryCost")
+
+
+def post_graphql(url, headers, query, throttle=None, cost=0):
+    """POST a GraphQL query, pacing it and retrying THROTTLED responses.
+
+    Waits until ``cost`` points are available in the throttle's bucket,
+    and retries a throttled request once its requested cost is restored.
+    Raises QueryCostExceeded when the query costs more than Shopify allows.
+    """
+    throttle = throttle or CostThrottle()
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        throttle.wait(cost)
+        response = session.post(url, headers=headers, json={"query": query})
+        if response.status_code == 429 and attempt < SHOPIFY_MAX_RETRIES:
+            ERRORS.inc(stage="shopify_throttled")
+            time.sleep(float(response.headers.get("Retry-After") or 2**attempt))
+            continue
+        response.raise_for_status()
+        result = response.json()
+        throttle.update(result)
+        codes = error_codes(result)
+        if "MAX_COST_EXCEEDED" in codes:
+            raise QueryCostExceeded(requested_cost(result) or cost)
+        if "THROTTLED" not in codes:
+            return result
+        ERRORS.inc(stage="shopify_throttled")
+        cost = requested_cost(result) or cost
+        delay = throttle.delay(cost) or min(60, 2**attempt)
+        logging.warning("Shopify throttled a request, retrying in %.1fs", delay)
+        time.sleep(delay)
+    raise RuntimeError(f"Shopify request still throttled after {attempt} retries")
+
+
+def plan_page(result_cost, first, variants, truncated, maximum=None):
+    """Page size, variants per product and expected cost of the next page.
+
+    A connection costs about ``first`` times the cost of its nodes, so the
+    reported cost per product and variant scales the next request. Variants
+    per product are doubled while products come back truncated, and the page
+    size is chosen to keep the requested cost under the single query limit
+    (and the bucket size).
+    """
+    if not result_cost:
+        return first, variants, 0
+    unit = result_cost / (first * (variants + 1))
+    if truncated:
+        variants = min(variants * 2, SHOPIFY_MAX_VARIANTS)
+    limit = min(MAX_QUERY_COST, maximum or MAX_QUERY_COST)
+    first = int(limit / (unit * (variants + 1)))
+    first = max(1, min(MAX_PAGE_SIZE, first))
+    return first, variants, unit * first * (variants + 1)
+
+
+def fetch_products(
+    url,
+    headers,
+    cursor=None,
+    first=SHOPIFY_PAGE_SIZE,
+    variants=SHOPIFY_VARIANTS,
+    throttle=None,
+    cost=0,
+):
+    """Adjust the GraphQL query to use the cursor if provided"""
+    after_clause = f', after: "{cursor}"' if cursor else ""
+    query = f"""
+    {{
+      products(first: {first}{after_clause}, query: "status:active AND published_status:published AND inventory_total:>0") {{
+        edges {{
+          cursor
+          node {{
+            id
+            title
+            description
+            tags
+            totalInventory
+            onlineStoreUrl
+            priceRange {{
+              maxVariantPrice {{
+                amount
+              }}
+            }}
+            featuredImage {{
+              url
+            }}
+            productType
+            tags
+            vendor
+            updatedAt
+            variants(first: {variants}) {{
+              pageInfo {{
+                hasNextPage
+              }}
+              edges {{
+                node {{
+                  id
+                  price 
+                  title
+                  inventoryQuantity
+                  image {{
+                    url
+                    
+                  }}
+                  selectedOptions {{
+                    name
+                    value
+                  }}
+                }}
+              }}
+            }}
+          }}
+        }}
+        pageInfo {{
+          hasNextPage
+        }}
+      }}
+    }}
+    """
+    try:
+        with STAGE_SECONDS.time(stage="shopify_page"):
+            return post_graphql(url, headers, query, throttle, cost)
+    except requests.RequestException as e:
+        ERRORS.inc(stage="shopify_page")
+        logging.error("Request failed: %s", e)
+        raise
+
+
+def iter_products(url, headers, cursor=None, on_page=None):
+    """Yield products page by page, only holding one page in memory.
+
+    ``on_page(cursor, count)`` is called as each page arrives with the page's
+    last cursor and the number of products up to and including the page.
+    Requests are paced by the reported cost bucket, and page and variant
+    counts adapt to the reported query cost.
+    """
+    has_next_page = True
+    count = 0
+    throttle = CostThrottle()
+    first, variants, cost = SHOPIFY_PAGE_SIZE, SHOPIFY_VARIANTS, 0
+
+    while has_next_page:
+        try:
+            result = fetch_products(
+                url, headers, cursor, first, variants, throttle, cost
+            )
+        except QueryCostExceeded as e:
+            if first == 1:
+                raise
+            planned, variants, cost = plan_page(
+                e.requested, first, variants, False, throttle.maximum
+            )
+            first = min(planned, first // 2)
+            logging.info("Query too expensive, retrying with %d products", first)
+            continue
+
+        products_data = result["data"]["products"]
+        if on_page is not None and products_data["edges"]:
+            on_page(
+                products_data["edges"][-1]["cursor"],
+                count + len(products_data["edges"]),
+            )
+        for edge in products_data["edges"]:
+            cursor = edge["cursor"]
+            count += 1
+            yield edge["node"]
+        has_next_page = products_data["pageInfo"]["hasNextPage"]
+        logging.info("running count of products: %d", count)
+        truncated = any(
+            edge["node"]["variants"].get("pageInfo", {}).get("hasNextPage")
+            for edge in products_data["edges"]
+        )
+        first, variants, cost = plan_page(
+            requested_cost(result), first, variants, truncated, throttle.maximum
+        )
+
+
+def paginate_through_all_products(url, headers):
+    """Fetch all products and return them in a list"""
+    return list(iter_products(url, headers))
+
+
+def graphql(url, headers, query):
+    """Run an Admin API GraphQL request, raising on GraphQL errors"""
+    result = post_graphql(url, headers, query)
+    if result.get("errors"):
+        raise RuntimeError(f"GraphQL errors: {result['errors']}")
+    return result["data"]
+
+
+def start_bulk_operation(url, headers, query=BULK_PRODUCTS_QUERY):
+    """Submit a bulk query, return the bulk operation id"""
+    mutation = (
+        "mutation { bulkOperationRunQuery(query: %s) "
+        "{ bulkOperation { id status } userErrors { field message } } }"
+        % json.dumps(query)
+    )
+    result = graphql(url, headers, mutation)["bulkOperationRunQuery"]
+    if result["userErrors"]:
+        raise RuntimeError(f"Bulk operation rejected: {result['userErrors']}")
+    return result["bulkOperation"]["id"]
+
+
+def wait_for_bulk_operation(
+    url, headers, operation_id, interval=BULK_POLL_INTERVAL, timeout=BULK_TIMEOUT
+):
+    """Poll until the bulk operation finishes, return its JSONL url (or None)"""
+    query = (
+        "{ currentBulkOperation "
+        "{ id status errorCode objectCount url partialDataUrl } }"
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        operation = graphql(url, headers, query)["currentBulkOperation"]
+        if operation is None or operation["id"] != operation_id:
+            raise RuntimeError(f"Bulk operation {operation_id} is no longer current")
+        if operation["status"] == "COMPLETED":
+            logging.info(
+                "Bulk operation %s completed with %s objects",
+                operation_id,
+                operation["objectCount"],
+            )
+            # No url when the query matched nothing
+            return operation["url"]
+        if operation["status"] in ("FAILED", "CANCELED", "CANCELING", "EXPIRED"):
+            raise RuntimeError(
+                f"Bulk operation {operation_id} {operation['status']}: "
+                f"{operation['errorCode']}"
+            )
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Bulk operation {operation_id} did not finish")
+        time.sleep(interval)
+
+
+def iter_jsonl(jsonl_url):
+    """Stream a JSONL file line by line, never holding the whole file"""
+    with requests.get(jsonl_url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def assemble_products(records):
+    """Rebuild product nodes from flat bulk JSONL records.
+
+    Bulk output lists each product followed by its variants, which point to
+    it through ``__parentId``; variants are nested back as
+    ``variants.edges[].node`` like fetch_products returns them. Only the
+    current product is held in memory.
+    """
+    product = None
+    orphans = 0
+    for record in records:
+        parent_id = record.pop("__parentId", None)
+        if parent_id is None:
+            if product is not None:
+                yield product
+            product = {**record, "variants": {"edges": []}}
+        elif product is not None and parent_id == product["id"]:
+            product["variants"]["edges"].append({"node": record})
+        else:
+            orphans += 1
+    if product is not None:
+        yield product
+    if orphans:
+        logging.warning("Skipped %d bulk records without a preceding parent", orphans)
+
+
+def iter_products_bulk(url, headers, on_page=None):
+    """Yield every product through a bulk operation instead of paging.
+
+    One bulk query replaces hundreds of paginated requests and is not
+    limited to 10 variants per product. ``on_page(None, count)`` reports
+    progress every BULK_PROGRESS_EVERY products; bulk results cannot be
+    resumed from a cursor.
+    """
+    with STAGE_SECONDS.time(stage="shopify_bulk"), ERRORS.count_exceptions(
+        stage="shopify_bulk"
+    ):
+        operation_id = start_bulk_operation(url, headers)
+        jsonl_url = wait_for_bulk_operation(url, headers, operation_id)
+    if jsonl_url is None:
+        return
+
+    count = 0
+    for product in assemble_products(iter_jsonl(jsonl_url)):
+        count += 1
+        yield product
+        if on_page is not None and count % BULK_PROGRESS_EVERY == 0:
+            on_page(None, count)
+    if on_page is not None and count % BULK_PROGRESS_EVERY:
+        on_page(None, count)
+    logging.info("bulk operation returned %d products", count)
@@ -0,0 +1,8 @@
+"""shared test setup."""
+
+import os
+
+# Modules create their Supabase clients on import; no request is sent
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test.anon.key")
+os.environ.setdefault("PRELOAD_MODELS", "")
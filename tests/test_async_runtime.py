@@ -0,0 +1,26 @@
+import os
+
+from async_runtime import after_fork
+
+
+class Resettable:
+    def __init__(self):
+        self.state = "parent"
+        after_fork(self.reset)
+
+    def reset(self):
+        self.state = None
+
+
+def test_after_fork_resets_in_child_only():
+    obj = Resettable()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write, repr(obj.state).encode())
+        os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    assert os.read(read, 100) == b"None"
+    os.close(read)
+    assert obj.state == "parent"
@@ -0,0 +1,21 @@
+"""embedding index tests."""
+
+import asyncio
+
+from embedding_index import ProductDetails
+
+
+def test_details_are_loaded_in_bounded_queries():
+    queries = []
+
+    async def loader(shop, product_ids):
+        queries.append(product_ids)
+        return [{"product_id": product_id} for product_id in product_ids]
+
+    details = ProductDetails(loader, query_size=2)
+    rows = asyncio.run(details.get_many("shop", ["a", "b", "c", "a"]))
+    assert sorted(rows) == ["a", "b", "c"]
+    assert queries == [["a", "b"], ["c"]]
+    # Cached rows are not queried again
+    asyncio.run(details.get_many("shop", ["a", "d"]))
+    assert queries[2:] == [["d"]]
@@ -0,0 +1,31 @@
+from image_cache import ImageEmbeddingCache, content_hash
+
+
+def test_get_many_by_url_returns_cached_urls(tmp_path):
+    cache = ImageEmbeddingCache(str(tmp_path), capacity=4)
+    cache.put("m", "https://a", content_hash(b"a"), [1.0, 0.0])
+    cache.put("m", "https://b", content_hash(b"b"), [0.0, 1.0])
+
+    found = cache.get_many_by_url("m", ["https://a", "https://b", "https://c"])
+
+    assert found == {"https://a": [1.0, 0.0], "https://b": [0.0, 1.0]}
+    assert cache.get_by_url("m", "https://c") is None
+    assert cache.get_by_hash("m", "https://d", content_hash(b"b")) == [0.0, 1.0]
+
+
+def test_hits_keep_entries_from_eviction(tmp_path):
+    cache = ImageEmbeddingCache(str(tmp_path), capacity=2)
+    cache.put("m", "https://a", content_hash(b"a"), [1.0])
+    cache.put("m", "https://b", content_hash(b"b"), [2.0])
+    # The hit on a is written before the next put picks a slot to evict
+    assert cache.get_by_url("m", "https://a") == [1.0]
+    cache.put("m", "https://c", content_hash(b"c"), [3.0])
+
+    assert cache.get_by_url("m", "https://a") == [1.0]
+    assert cache.get_by_url("m", "https://b") is None
+
+
+def test_index_uses_wal(tmp_path):
+    cache = ImageEmbeddingCache(str(tmp_path))
+    mode = cache._conn.execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
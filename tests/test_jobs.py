@@ -0,0 +1,68 @@
+"""sync job store tests."""
+
+import os
+
+import pytest
+
+from jobs import JobStore, ShopBusy, process_alive, process_start_time
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "sync_jobs.sqlite3"))
+
+
+def test_per_shop_limit_refuses_second_job(store, tmp_path):
+    job_id = store.create("a.myshopify.com", limit=1)
+    # A second store stands in for another worker process on the same file
+    other = JobStore(str(tmp_path / "sync_jobs.sqlite3"))
+    with pytest.raises(ShopBusy) as busy:
+        other.create("a.myshopify.com", limit=1)
+    assert busy.value.job_id == job_id
+    assert other.create("b.myshopify.com", limit=1)
+
+
+def test_per_shop_limit_frees_finished_jobs(store):
+    job_id = store.create("a.myshopify.com", limit=1)
+    store.update(job_id, status="completed")
+    assert store.create("a.myshopify.com", limit=1)
+
+
+def test_reused_pid_is_not_alive(store):
+    job_id = store.create("a.myshopify.com", limit=1)
+    started = store.get(job_id)["pid_started"]
+    if started is None:
+        pytest.skip("process start times are not available")
+    # Same pid, different process: e.g. a worker of a restarted container
+    store.update(job_id, status="running", pid_started=started - 1)
+    assert store.get(job_id)["status"] == "interrupted"
+    assert store.create("a.myshopify.com", limit=1)
+
+
+def test_process_alive():
+    pid = os.getpid()
+    assert process_alive(pid)
+    assert process_alive(pid, process_start_time(pid))
+    assert not process_alive(None)
+
+
+def test_resume_cursor_of_failed_job(store):
+    job_id = store.create("a.myshopify.com")
+    store.update(job_id, status="failed", cursor="42")
+    assert store.resume_cursor("a.myshopify.com") == "42"
+    assert store.resume_cursor("b.myshopify.com") is None
+
+
+def test_no_resume_after_completed_job(store):
+    failed = store.create("a.myshopify.com")
+    store.update(failed, status="failed", cursor="42")
+    completed = store.create("a.myshopify.com")
+    store.update(completed, status="completed", cursor="99")
+    assert store.resume_cursor("a.myshopify.com") is None
+
+
+def test_resume_cursor_of_interrupted_job(store):
+    job_id = store.create("a.myshopify.com")
+    store.update(job_id, status="running", cursor="7", pid=None)
+    assert store.get(job_id)["status"] == "interrupted"
+    assert store.resume_cursor("a.myshopify.com") == "7"
@@ -0,0 +1,19 @@
+"""product processing helper tests."""
+
+from process_product import product_fingerprint, variant_image_url
+
+
+def variant(image=None):
+    return {"node": {"id": "v1", "image": image}}
+
+
+def test_variant_image_url_falls_back_to_the_product_image():
+    product = {"featuredImage": {"url": "https://p"}}
+    assert variant_image_url(variant({"url": "https://v"}), product) == "https://v"
+    assert variant_image_url(variant(), product) == "https://p"
+
+
+def test_variant_image_url_without_any_image():
+    product = {"id": "p1", "featuredImage": None, "variants": {"edges": [variant()]}}
+    assert variant_image_url(variant(), product) == ""
+    assert product_fingerprint(product)
@@ -0,0 +1,120 @@
+"""webhook queue tests."""
+
+import json
+import os
+
+import pytest
+
+import webhook_queue
+from jobs import process_start_time
+from webhook_queue import WebhookQueue
+
+SHOP = "a.myshopify.com"
+
+
+def product(product_id, updated_at="2024-01-01T00:00:00Z", **fields):
+    return {"id": product_id, "updatedAt": updated_at, **fields}
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_DEBOUNCE_SECONDS", 0)
+    queue = WebhookQueue(str(tmp_path / "webhook_queue.sqlite3"))
+    # Drained by the tests instead of a background thread
+    queue._draining = True
+    return queue
+
+
+def processor(processed, fail_on=(), raise_on=()):
+    """A process() stand-in recording the product ids of each call"""
+
+    async def process(products, shop):
+        ids = [p["id"] for p in products]
+        processed.append(ids)
+        if any(product_id in raise_on for product_id in ids):
+            raise RuntimeError("batch failed")
+        failed = [product_id for product_id in ids if product_id in fail_on]
+        return {"processed": len(ids) - len(failed), "skipped": 0, "failed": failed}
+
+    return process
+
+
+def test_enqueue_keeps_the_newest_version(queue):
+    queue.enqueue(SHOP, product("p1", "2024-01-02T00:00:00Z", title="new"))
+    queue.enqueue(SHOP, product("p1", "2024-01-01T00:00:00Z", title="old"))
+    [update] = queue.claim()
+    assert json.loads(update["payload"])["title"] == "new"
+    assert update["version"] == 1
+
+
+def test_enqueue_waits_for_the_debounce_window(queue, monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_DEBOUNCE_SECONDS", 60)
+    queue.enqueue(SHOP, product("p1"))
+    assert queue.claim() == []
+    assert queue.depth() == 1
+
+
+def claim_as(queue, pid, started):
+    queue._conn.execute(
+        "UPDATE webhook_updates SET claimed_by = ?, claimed_started = ?",
+        (pid, started),
+    )
+    queue._conn.commit()
+
+
+def test_claims_of_live_processes_are_kept(queue):
+    queue.enqueue(SHOP, product("p1"))
+    # The parent process stands in for another live worker
+    claim_as(queue, os.getppid(), process_start_time(os.getppid()))
+    assert queue.claim() == []
+
+
+def test_claims_of_dead_processes_are_released(queue):
+    queue.enqueue(SHOP, product("p1"))
+    started = process_start_time(os.getpid())
+    if started is None:
+        pytest.skip("process start times are not available")
+    # Same pid, earlier start time: the claiming process has exited
+    claim_as(queue, os.getpid(), started - 1)
+    assert [update["product_id"] for update in queue.claim()] == ["p1"]
+
+
+def test_complete_keeps_updates_received_while_processing(queue):
+    queue.enqueue(SHOP, product("p1"))
+    claimed = queue.claim()
+    queue.enqueue(SHOP, product("p1", "2024-01-02T00:00:00Z"))
+    queue.complete(claimed)
+    [update] = queue.claim()
+    assert update["version"] == 2
+
+
+def test_failed_updates_are_retried_then_dropped(queue, monkeypatch):
+    monkeypatch.setattr(webhook_queue, "WEBHOOK_MAX_ATTEMPTS", 2)
+    queue.enqueue(SHOP, product("p1"))
+    queue.fail(queue.claim())
+    [update] = queue.claim()
+    assert update["attempts"] == 1
+    queue.fail([update])
+    assert queue.depth() == 0
+
+
+def test_drain_completes_written_and_retries_failed_products(queue):
+    processed = []
+    queue.process = processor(processed, fail_on={"p2"})
+    queue.enqueue(SHOP, product("p1"))
+    queue.enqueue(SHOP, product("p2"))
+    assert queue.drain_once() == 2
+    assert processed == [["p1", "p2"]]
+    [update] = queue.claim()
+    assert (update["product_id"], update["attempts"]) == ("p2", 1)
+
+
+def test_drain_retries_a_failed_batch_one_product_at_a_time(queue):
+    processed = []
+    queue.process = processor(processed, raise_on={"p2"})
+    queue.enqueue(SHOP, product("p1"))
+    queue.enqueue(SHOP, product("p2"))
+    queue.drain_once()
+    assert processed == [["p1", "p2"], ["p1"], ["p2"]]
+    [update] = queue.claim()
+    assert (update["product_id"], update["attempts"]) == ("p2", 1)
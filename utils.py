@@ -1,34 +1,91 @@
 """utils script."""
 
+import hashlib
+import logging
 import requests
+from requests.adapters import HTTPAdapter
+from image_cache import image_cache
 
-image_embedding_map = {}
+EMBED_SERVICE_URL = "https://populatedb-production.up.railway.app"
+EMBED_IMAGE_URL = f"{EMBED_SERVICE_URL}/embed-image"
+
+# Pooled keep-alive connections to the embedding service
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 
 def get_image_embedding(image_url):
     """Get image embedding"""
-    image_embedding = []
-    if image_url not in image_embedding_map:
-        response = requests.post(
-            "https://populatedb-production.up.railway.app/embed-image",
-            json={"imageUrl": image_url},
-            headers={"Content-Type": "application/json"},
-        )
+    if image_cache is not None:
+        image_embedding = image_cache.get_by_url(EMBED_IMAGE_URL, image_url)
+        if image_embedding is not None:
+            logging.debug("Skipped image embed for %s (cache)", image_url)
+            return image_embedding
 
-        image_embedding = response.json()
-    else:
-        print(f"Skipped image embed for {image_url} (cache)")
+    response = session.post(
+        EMBED_IMAGE_URL,
+        json={"imageUrl": image_url},
+        headers={"Content-Type": "application/json"},
+    )
+    image_embedding = response.json()
 
+    if image_embedding:
+        cache_image_embedding(image_url, image_embedding)
     return image_embedding
 
 
+def cache_image_embedding(image_url, image_embedding):
+    """Store a remotely computed image embedding in the persistent cache"""
+    if image_cache is not None:
+        # The remote service downloads the image, so key it by its URL
+        digest = hashlib.sha256(image_url.encode("utf-8")).hexdigest()
+        image_cache.put(EMBED_IMAGE_URL, image_url, f"url:{digest}", image_embedding)
+
+
 def get_text_embedding(description):
     """Get text embedding"""
-    response = requests.post(
-        "https://populatedb-production.up.railway.app/embed-text",
+    response = session.post(
+        f"{EMBED_SERVICE_URL}/embed-text",
         json={"description": f"{description}"},
         headers={"Content-Type": "application/json"},
     )
 
     text_embedding = response.json()
     return text_embedding
+
+
+def get_text_embeddings(descriptions):
+    """Get text embeddings in one request, None for items that failed"""
+    response = session.post(
+        f"{EMBED_SERVICE_URL}/embed-text/batch",
+        json={"descriptions": [f"{description}" for description in descriptions]},
+        headers={"Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+    return [result.get("embedding") for result in response.json()["results"]]
+
+
+def get_image_embeddings(image_urls):
+    """Get image embeddings in one request, None for items that failed"""
+    embeddings = {}
+    if image_cache is not None:
+        embeddings = image_cache.get_many_by_url(EMBED_IMAGE_URL, image_urls)
+
+    missing = list(dict.fromkeys(url for url in image_urls if url not in embeddings))
+    if missing:
+        response = session.post(
+            f"{EMBED_IMAGE_URL}/batch",
+            json={"imageUrls": missing},
+            headers={"Content-Type": "application/json"},
+        )
+        response.raise_for_status()
+        for image_url, result in zip(missing, response.json()["results"]):
+            embedding = result.get("embedding")
+            if embedding is None:
+                logging.warning(
+                    "Error embedding image %s: %s", image_url, result.get("error")
+                )
+                continue
+            embeddings[image_url] = embedding
+            cache_image_embedding(image_url, embedding)
+    return [embeddings.get(image_url) for image_url in image_urls]
@@ -0,0 +1,275 @@
+"""durable queue coalescing product webhooks."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from async_runtime import after_fork, run_async
+from jobs import process_alive, process_start_time
+from metrics import ERRORS, STAGE_SECONDS, CallbackGauge
+from process_product import handle_product_updates
+
+WEBHOOK_QUEUE_PATH = os.environ.get("WEBHOOK_QUEUE_PATH", "webhook_queue.sqlite3")
+# Seconds a product must go without further webhooks before it is processed,
+# and the longest a product keeps being postponed by new webhooks
+WEBHOOK_DEBOUNCE_SECONDS = float(os.environ.get("WEBHOOK_DEBOUNCE_SECONDS", 5))
+WEBHOOK_MAX_DELAY_SECONDS = float(os.environ.get("WEBHOOK_MAX_DELAY_SECONDS", 60))
+# Products claimed and processed together by one drain step
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", 100))
+# Seconds between drain steps while the queue has nothing due
+WEBHOOK_POLL_INTERVAL = float(os.environ.get("WEBHOOK_POLL_INTERVAL", 1))
+# Failed updates are retried with backoff, then dropped
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 5))
+
+UPDATE_FIELDS = ("shop", "product_id", "payload", "version", "attempts")
+
+
+class WebhookQueue:
+    """sqlite queue of product updates, one row per shop and product.
+
+    A webhook replaces the queued payload of its product, unless it is older
+    than the queued one (by ``updatedAt``), and postpones it by the debounce
+    window. Every worker process on the host runs a drain thread; rows are
+    claimed by pid and process start time, so an update is processed once,
+    claims of dead processes are released, and a row is only
+    removed if no newer webhook arrived while it was processed.
+    """
+
+    def __init__(self, path=WEBHOOK_QUEUE_PATH, process=handle_product_updates):
+        self.path = path
+        self.process = process
+        self._reset()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._db = None
+        self._draining = False
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._create_table()
+        return self._db
+
+    def _create_table(self):
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_updates ("
+            "shop TEXT, product_id TEXT, payload TEXT, updated_at TEXT, "
+            "version INTEGER DEFAULT 1, attempts INTEGER DEFAULT 0, "
+            "received_at REAL, due_at REAL, claimed_by INTEGER, "
+            "claimed_started INTEGER, PRIMARY KEY (shop, product_id))"
+        )
+        columns = [
+            row[1] for row in self._db.execute("PRAGMA table_info(webhook_updates)")
+        ]
+        if "claimed_started" not in columns:
+            self._db.execute(
+                "ALTER TABLE webhook_updates ADD COLUMN claimed_started INTEGER"
+            )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS webhook_updates_due "
+            "ON webhook_updates (due_at)"
+        )
+        self._db.commit()
+
+    def enqueue(self, shop, product):
+        """Queue the latest version of a product for processing"""
+        now = time.time()
+        with self._lock:
+            # An update received while the row is claimed gets a new version,
+            # which stays queued when the claimed version completes
+            self._conn.execute(
+                "INSERT INTO webhook_updates (shop, product_id, payload, "
+                "updated_at, received_at, due_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (shop, product_id) DO UPDATE SET "
+                "payload = excluded.payload, updated_at = excluded.updated_at, "
+                "version = version + 1, attempts = 0, "
+                "due_at = MIN(excluded.due_at, received_at + ?) "
+                "WHERE excluded.updated_at >= updated_at",
+                (
+                    shop,
+                    product["id"],
+                    json.dumps(product),
+                    product.get("updatedAt") or "",
+                    now,
+                    now + WEBHOOK_DEBOUNCE_SECONDS,
+                    WEBHOOK_MAX_DELAY_SECONDS,
+                ),
+            )
+            self._conn.commit()
+        self.start()
+
+    def depth(self):
+        """Number of queued product updates"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM webhook_updates"
+            ).fetchone()[0]
+
+    def _release_dead_claims(self):
+        claims = self._conn.execute(
+            "SELECT DISTINCT claimed_by, claimed_started FROM webhook_updates "
+            "WHERE claimed_by IS NOT NULL"
+        ).fetchall()
+        dead = [claim for claim in claims if not process_alive(*claim)]
+        self._conn.executemany(
+            "UPDATE webhook_updates SET claimed_by = NULL, claimed_started = NULL "
+            "WHERE claimed_by = ? AND claimed_started IS ?",
+            dead,
+        )
+
+    def claim(self, limit=WEBHOOK_BATCH_SIZE):
+        """Claim due updates for this process, return them as dicts"""
+        pid = os.getpid()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._release_dead_claims()
+                self._conn.execute(
+                    "UPDATE webhook_updates SET claimed_by = ?, claimed_started = ? "
+                    "WHERE rowid IN (SELECT rowid FROM webhook_updates "
+                    "WHERE claimed_by IS NULL AND due_at <= ? "
+                    "ORDER BY due_at LIMIT ?)",
+                    (pid, process_start_time(pid), time.time(), limit),
+                )
+                rows = self._conn.execute(
+                    f"SELECT {', '.join(UPDATE_FIELDS)} FROM webhook_updates "
+                    "WHERE claimed_by = ?",
+                    (pid,),
+                ).fetchall()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return [dict(zip(UPDATE_FIELDS, row)) for row in rows]
+
+    def _release(self, updates):
+        self._conn.executemany(
+            "UPDATE webhook_updates SET claimed_by = NULL, claimed_started = NULL "
+            "WHERE shop = ? AND product_id = ? AND claimed_by = ?",
+            [(update["shop"], update["product_id"], os.getpid()) for update in updates],
+        )
+
+    def complete(self, updates):
+        """Remove processed updates, releasing those replaced in the meantime"""
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM webhook_updates "
+                "WHERE shop = ? AND product_id = ? AND version = ?",
+                [
+                    (update["shop"], update["product_id"], update["version"])
+                    for update in updates
+                ],
+            )
+            self._release(updates)
+            self._conn.commit()
+
+    def fail(self, updates):
+        """Release failed updates for a retry with backoff, or drop them"""
+        now = time.time()
+        with self._lock:
+            for update in updates:
+                attempts = update["attempts"] + 1
+                if attempts >= WEBHOOK_MAX_ATTEMPTS:
+                    logging.error(
+                        "Dropping update of %s after %d attempts",
+                        update["product_id"],
+                        attempts,
+                    )
+                    self._conn.execute(
+                        "DELETE FROM webhook_updates "
+                        "WHERE shop = ? AND product_id = ? AND version = ?",
+                        (update["shop"], update["product_id"], update["version"]),
+                    )
+                    continue
+                self._conn.execute(
+                    "UPDATE webhook_updates SET attempts = ?, due_at = ? "
+                    "WHERE shop = ? AND product_id = ? AND version = ?",
+                    (
+                        attempts,
+                        now + WEBHOOK_DEBOUNCE_SECONDS * 2**attempts,
+                        update["shop"],
+                        update["product_id"],
+                        update["version"],
+                    ),
+                )
+            self._release(updates)
+            self._conn.commit()
+
+    def _process(self, shop, updates):
+        """Process a shop's updates, return those that were not written"""
+        products = [json.loads(update["payload"]) for update in updates]
+        with STAGE_SECONDS.time(stage="webhook_batch"):
+            result = run_async(self.process(products, shop))
+        logging.info(
+            "Webhook updates for %s: %d products processed, %d unchanged, %d failed",
+            shop,
+            result["processed"],
+            result["skipped"],
+            len(result["failed"]),
+        )
+        failed = set(result["failed"])
+        return [update for update in updates if update["product_id"] in failed]
+
+    def _drain(self, shop, updates):
+        try:
+            failed = self._process(shop, updates)
+        except Exception as e:
+            ERRORS.inc(stage="webhook_batch")
+            logging.error(
+                "Webhook batch of %d for %s failed: %s", len(updates), shop, e
+            )
+            if len(updates) > 1:
+                # Retried one at a time, so a bad product only fails its own update
+                for update in updates:
+                    self._drain(shop, [update])
+                return
+            failed = updates
+        # Products that were not written stay queued for a retry
+        self.complete([update for update in updates if update not in failed])
+        self.fail(failed)
+
+    def drain_once(self):
+        """Process one batch of due updates, return how many were claimed"""
+        updates = self.claim()
+        by_shop = {}
+        for update in updates:
+            by_shop.setdefault(update["shop"], []).append(update)
+        for shop, shop_updates in by_shop.items():
+            self._drain(shop, shop_updates)
+        return len(updates)
+
+    def _drain_forever(self):
+        while True:
+            try:
+                if self.drain_once() < WEBHOOK_BATCH_SIZE:
+                    time.sleep(WEBHOOK_POLL_INTERVAL)
+            except Exception as e:
+                logging.error("Webhook queue drain failed: %s", e)
+                time.sleep(WEBHOOK_POLL_INTERVAL)
+
+    def start(self):
+        """Start this process's drain thread if it is not running"""
+        with self._lock:
+            if self._draining:
+                return
+            self._draining = True
+        threading.Thread(
+            target=self._drain_forever, name="webhook-drain", daemon=True
+        ).start()
+
+
+webhook_queue = WebhookQueue()
+
+CallbackGauge(
+    "product_service_webhook_queue_depth",
+    "Product updates waiting in the webhook queue.",
+    [],
+    lambda: {(): webhook_queue.depth()},
+)